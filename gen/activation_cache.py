@@ -0,0 +1,159 @@
+import hashlib
+import os
+from contextlib import contextmanager
+from types import MethodType
+
+import numpy as np
+import torch
+
+from block_loader import block_dataloader
+from lm_head import get_decoder_layers, get_final_norm, unwrap_causal_lm
+
+CACHE_VERSION = 1
+
+
+def _pass_through(self, hidden_states, *args, **kwargs):
+    return hidden_states
+
+
+class IndexedBlocks(torch.utils.data.Dataset):
+    """
+    A block dataset whose batches also carry block_index (the dataset index of every row) and
+    block_split (the split id), so that cached activations can be looked up.
+    """
+
+    def __init__(self, dataset, split_id):
+        self.dataset = dataset
+        self.split_id = split_id
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def fingerprint(self):
+        # The index columns do not change the blocks: caches keyed on them (RefLossCache) are shared
+        return getattr(self.dataset, "fingerprint", None) or self.dataset._fingerprint
+
+    def __getitem__(self, i):
+        return dict(self.dataset[i], block_index=i, block_split=self.split_id)
+
+    def __getitems__(self, indices):
+        batch = dict(self.dataset.__getitems__(indices))
+        batch["block_index"] = np.asarray(indices, dtype=np.int64)
+        batch["block_split"] = np.full(len(indices), self.split_id, dtype=np.int64)
+        return batch
+
+    def select(self, indices):
+        return torch.utils.data.Subset(self, [int(i) for i in indices])
+
+
+class ActivationCache:
+    """
+    Hidden states of the frozen part of the model on every block of the train and validation
+    sets, computed once with the pretrained weights and stored as [blocks, block_size, hidden]
+    .npy files (float32, or float16 to halve them) that are memory-mapped on load.
+
+    With layer=None the frozen part is the whole backbone (--train_head_only) and the cache
+    holds the final, normed hidden states; with layer=n it is everything below block n
+    (--train_layer_n_only) and the cache holds the input of block n. Files are keyed like
+    RefLossCache, by the model name, the frozen part, the dtype and the dataset fingerprint.
+
+    inject() then runs the model on a batch of cached blocks with the frozen blocks turned
+    into pass-throughs and the cached states fed in where they are needed, so the forward
+    (and backward) only covers the trainable tail, through the usual top-level model call.
+    """
+
+    def __init__(self, cache_dir, model_name, splits, layer=None, dtype="float32"):
+        self.cache_dir = cache_dir
+        self.layer = layer
+        self.dtype = np.dtype(dtype)
+        self.names = list(splits)
+        self.datasets = [splits[name] for name in self.names]
+        self.paths = []
+        for name, dataset in zip(self.names, self.datasets):
+            fingerprint = getattr(dataset, "fingerprint", None) or dataset._fingerprint
+            part = "head" if layer is None else f"layer{layer}"
+            key = f"{model_name}|{part}|{self.dtype}|{fingerprint}|{len(dataset)}|{CACHE_VERSION}"
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+            self.paths.append(os.path.join(cache_dir, f"activations_{name}_{part}_{digest}.npy"))
+        self.arrays = []
+
+    def indexed(self, name):
+        split_id = self.names.index(name)
+        return IndexedBlocks(self.datasets[split_id], split_id)
+
+    def missing(self):
+        return [name for name, path in zip(self.names, self.paths) if not os.path.exists(path)]
+
+    def compute(self, accelerator, model, name, block_size, batch_size):
+        """
+        Computes the cached states of one split, sharded across processes; every process writes
+        its rows into the same memory-mapped file, which the main process then publishes.
+        """
+        path = self.paths[self.names.index(name)]
+        tmp_path = f"{path}.tmp.npy"
+        dataset = self.indexed(name)
+        hidden_size = unwrap_causal_lm(model).config.get_text_config().hidden_size
+        if accelerator.is_main_process:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=self.dtype, shape=(len(dataset), block_size, hidden_size)
+            ).flush()
+        accelerator.wait_for_everyone()
+
+        states = np.load(tmp_path, mmap_mode="r+")
+        dataloader = accelerator.prepare(block_dataloader(dataset, batch_size))
+        model.eval()
+        with torch.no_grad():
+            for batch in dataloader:
+                outputs = model(
+                    input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                    output_hidden_states=True, logits_to_keep=1, use_cache=False,
+                )
+                hidden = outputs.hidden_states[-1 if self.layer is None else self.layer]
+                rows = batch["block_index"].cpu().numpy()
+                states[rows, :hidden.size(1)] = hidden.float().cpu().numpy().astype(self.dtype)
+        states.flush()
+        del states
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            os.replace(tmp_path, path)
+        accelerator.wait_for_everyone()
+
+    def load(self):
+        self.arrays = [np.load(path, mmap_mode="r") for path in self.paths]
+        return self
+
+    @contextmanager
+    def inject(self, model, batch):
+        """
+        Within the block, model calls on this batch take the frozen states from the cache.
+        Keep the backward inside it too: checkpointed blocks are recomputed in backward.
+        """
+        lm = unwrap_causal_lm(model)
+        parameter = next(lm.parameters())
+        rows = batch["block_index"].cpu().numpy()
+        states = self.arrays[int(batch["block_split"][0])][rows][:, :batch["input_ids"].size(1)]
+        hidden = torch.from_numpy(np.asarray(states)).to(device=parameter.device, dtype=parameter.dtype)
+
+        layers = get_decoder_layers(lm)
+        if self.layer is None:
+            frozen = list(layers)
+            handle = get_final_norm(lm).register_forward_hook(lambda module, args, output: hidden)
+        else:
+            frozen = list(layers[:self.layer])
+
+            def feed(module, args, kwargs):
+                if args:
+                    return (hidden,) + tuple(args[1:]), kwargs
+                return args, dict(kwargs, hidden_states=hidden)
+
+            handle = layers[self.layer].register_forward_pre_hook(feed, with_kwargs=True)
+        for block in frozen:
+            block.forward = MethodType(_pass_through, block)
+        try:
+            yield
+        finally:
+            handle.remove()
+            for block in frozen:
+                del block.forward
@@ -0,0 +1,99 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class AsyncEvaluator:
+    """
+    Runs evaluation jobs on a replica of the model in a background thread, so that training
+    can move on to the next epoch while the previous one is being evaluated.
+
+    The replica shares every frozen parameter with the training model; only the trainable
+    ones (full model, LoRA adapters or head) are copied. At each submit() the trainable
+    parameters are snapshotted and loaded into the replica right before the job runs.
+
+    A job's optional on_done(result) callback runs in the calling thread, once the job is
+    collected (by a later submit(), collect() or wait()), in submission order: logging and
+    printing stay out of the background thread.
+    """
+
+    def __init__(self, model, max_pending=1):
+        frozen = {id(p): p for p in model.parameters() if not p.requires_grad}
+        self.replica = copy.deepcopy(model, memo=frozen)
+        self.replica.eval()
+        self.replica_params = dict(self.replica.named_parameters())
+        for p in self.replica_params.values():
+            p.requires_grad_(False)
+
+        self.model = model
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def snapshot(self):
+        """
+        Copies of the trainable parameters of the training model, by name.
+        """
+        with torch.no_grad():
+            return {n: p.detach().clone() for n, p in self.model.named_parameters() if p.requires_grad}
+
+    def submit(self, job, on_done=None):
+        """
+        Schedules job(replica) on the current weights. Blocks only if max_pending jobs are
+        still queued, which bounds the number of snapshots held in memory.
+        """
+        self.collect()
+        while len(self.pending) >= self.max_pending:
+            self._finish(self.pending.pop(0))
+
+        weights = self.snapshot()
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+        self.pending.append((self.executor.submit(self._run, job, weights, ready), on_done))
+
+    def collect(self):
+        """
+        Runs the callbacks of the jobs finished so far (stopping at the first one still running).
+        """
+        while self.pending and self.pending[0][0].done():
+            self._finish(self.pending.pop(0))
+
+    @staticmethod
+    def _finish(entry):
+        future, on_done = entry
+        result = future.result()
+        if on_done is not None:
+            on_done(result)
+
+    def _run(self, job, weights, ready):
+        if self.stream is None:
+            self._load(weights)
+            return job(self.replica)
+        # Evaluate on a side stream, after the snapshot copies issued on the training stream.
+        self.stream.wait_event(ready)
+        with torch.cuda.stream(self.stream):
+            self._load(weights)
+            result = job(self.replica)
+        self.stream.synchronize()
+        return result
+
+    def _load(self, weights):
+        with torch.no_grad():
+            for name, value in weights.items():
+                self.replica_params[name].copy_(value)
+
+    def wait(self):
+        """
+        Waits for every submitted job and runs its callback, re-raising the first error.
+        """
+        pending, self.pending = self.pending, []
+        for entry in pending:
+            self._finish(entry)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import default_data_collator
+
+
+def collate_blocks(batch):
+    """
+    Batches already gathered by a dataset's __getitems__ (a dict of arrays) only become
+    tensors, sharing their memory; lists of items go through default_data_collator.
+    """
+    if isinstance(batch, dict):
+        return {key: torch.from_numpy(np.ascontiguousarray(values)) for key, values in batch.items()}
+    return default_data_collator(batch)
+
+
+def block_dataloader(dataset, batch_size, shuffle=False, seed=None, num_workers=0, prefetch_factor=2):
+    """
+    DataLoader over packed blocks (PackedBlocks, InjectedDataset or a Subset of them) fetching
+    every batch with one __getitems__ call. Shuffling uses its own generator seeded with seed,
+    so the order does not depend on how much of the global RNG was consumed before.
+    num_workers > 0 prefetches prefetch_factor batches per worker process; batches are pinned
+    when a GPU is present.
+    """
+    generator = torch.Generator().manual_seed(seed) if shuffle and seed is not None else None
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        generator=generator,
+        collate_fn=collate_blocks,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+        pin_memory=torch.cuda.is_available(),
+    )
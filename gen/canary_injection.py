@@ -0,0 +1,91 @@
+import hashlib
+
+import numpy as np
+import torch
+
+IGNORE_INDEX = -100
+
+
+def canary_table(token_lists, block_size, pad_token_id, tags=None):
+    """
+    One training block per canary: its token ids (truncated to block_size) right-padded to
+    block_size, padding masked out of attention_mask and labels. With tags (one int per canary,
+    -1 for untracked canaries) the blocks also carry the canary_tag / canary_pos telemetry
+    columns (-1 on padding and on untracked canaries). Returns a dict of [n, block_size] arrays.
+    """
+    n = len(token_lists)
+    input_ids = np.full((n, block_size), pad_token_id, dtype=np.int64)
+    lengths = np.array([min(len(ids), block_size) for ids in token_lists], dtype=np.int64)
+    for row, ids in enumerate(token_lists):
+        input_ids[row, :lengths[row]] = ids[:block_size]
+    real = np.arange(block_size)[None, :] < lengths[:, None]
+
+    table = {
+        "input_ids": input_ids,
+        "attention_mask": real.astype(np.int64),
+        "labels": np.where(real, input_ids, IGNORE_INDEX),
+    }
+    if tags is not None:
+        tracked = real & (np.asarray(tags)[:, None] >= 0)
+        table["canary_tag"] = np.where(tracked, np.asarray(tags)[:, None], -1)
+        table["canary_pos"] = np.where(tracked, np.arange(block_size)[None, :], -1)
+    return table
+
+
+class InjectedDataset(torch.utils.data.Dataset):
+    """
+    Training set made of the unmodified base blocks followed by canary blocks addressed through
+    an index: item len(base) + j is row index[j] of the canary table, so a canary repeated r times
+    is r index entries and the corpus is never copied, re-hashed or re-shuffled (the sampler
+    shuffles). With tag_base=True the base blocks get canary_tag / canary_pos = -1 on the fly,
+    so that they collate with tagged canary blocks.
+    """
+
+    def __init__(self, base, table, index, tag_base=False):
+        self.base = base
+        self.table = table
+        self.index = np.asarray(index, dtype=np.int64)
+        self.tag_base = tag_base
+
+        content = hashlib.sha1(str(getattr(base, "fingerprint", None) or getattr(base, "_fingerprint", len(base))).encode("utf-8"))
+        for key in sorted(table):
+            content.update(key.encode("utf-8"))
+            content.update(np.ascontiguousarray(table[key]).tobytes())
+        content.update(self.index.tobytes())
+        self.fingerprint = content.hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.base) + len(self.index)
+
+    def __getitem__(self, i):
+        if i < len(self.base):
+            item = self.base[i]
+            if self.tag_base:
+                untagged = [-1] * len(item["input_ids"])
+                item = dict(item, canary_tag=untagged, canary_pos=untagged)
+            return item
+        row = self.index[i - len(self.base)]
+        return {key: values[row].tolist() for key, values in self.table.items()}
+
+    def __getitems__(self, indices):
+        """
+        A whole batch as a dict of [len(indices), block_size] int64 arrays: the base blocks are
+        gathered in one call (the base must provide __getitems__, like PackedBlocks), the
+        canary blocks are rows of the table.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        is_base = indices < len(self.base)
+        width = self.table["input_ids"].shape[1]
+        rows = self.index[indices[~is_base] - len(self.base)]
+        base = self.base.__getitems__(indices[is_base], width=width)
+
+        batch = {}
+        for key, values in self.table.items():
+            column = np.empty((len(indices), width), dtype=np.int64)
+            column[is_base] = base[key] if key in base else -1
+            column[~is_base] = values[rows]
+            batch[key] = column
+        return batch
+
+    def select(self, indices):
+        return torch.utils.data.Subset(self, [int(i) for i in indices])
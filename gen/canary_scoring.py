@@ -0,0 +1,309 @@
+import copy
+
+import torch
+
+from lm_head import backbone_forward, gather_positions, get_lm_head
+
+
+def length_buckets(lengths, batch_size):
+    """
+    Groups indices of sequences with similar length together so that padding stays minimal.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def pad_batch(sequences, pad_token_id, device):
+    """
+    Right-pads a list of token id lists into input_ids / attention_mask tensors.
+    """
+    max_len = max(len(s) for s in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for row, seq in enumerate(sequences):
+        input_ids[row, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+        attention_mask[row, :len(seq)] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+
+def logit_stats(logits, input_ids, prefix, top_k=0):
+    """
+    Reduces next-token logits [batch, seq_len, vocab] to what the canary metrics need:
+    target log-probs, argmax ids and target ranks (1 = argmax) [batch, seq_len - 1]
+    (position t predicts input_ids[:, t + 1]), plus the top-k (log-probs, ids) right after
+    the prefix when top_k > 0. prefix is a [batch] tensor of prefix lengths.
+    """
+    logprobs = torch.log_softmax(logits[:, :-1, :].float(), dim=-1)
+    target = logprobs.gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+    greedy = logprobs.argmax(dim=-1)
+    rank = (logprobs > target.unsqueeze(-1)).sum(dim=-1) + 1
+    top = None
+    if top_k > 0:
+        rows = torch.arange(input_ids.size(0), device=input_ids.device)
+        top = torch.topk(logprobs[rows, (prefix - 1).clamp(min=0)], top_k, dim=-1)
+    return target, greedy, top, rank
+
+
+def chunked_logit_stats(model, hidden, input_ids, prefix, top_k=0, chunk_size=None):
+    """
+    Same as logit_stats, but starting from the final hidden states and applying the LM head
+    over chunks of chunk_size positions, so at most [batch, chunk_size, vocab] logits exist.
+    """
+    head = get_lm_head(model)
+    n_targets = hidden.size(1) - 1
+    chunk_size = chunk_size or max(n_targets, 1)
+    after_prefix = (prefix - 1).clamp(min=0)
+    targets, greedys, ranks = [], [], []
+    top_lp = top_ids = None
+    if top_k > 0:
+        top_lp = torch.zeros((input_ids.size(0), top_k), device=input_ids.device)
+        top_ids = torch.zeros((input_ids.size(0), top_k), dtype=torch.long, device=input_ids.device)
+
+    for start in range(0, n_targets, chunk_size):
+        end = min(start + chunk_size, n_targets)
+        logprobs = torch.log_softmax(head(hidden[:, start:end]).float(), dim=-1)
+        targets.append(logprobs.gather(-1, input_ids[:, start + 1:end + 1].unsqueeze(-1)).squeeze(-1))
+        greedys.append(logprobs.argmax(dim=-1))
+        ranks.append((logprobs > targets[-1].unsqueeze(-1)).sum(dim=-1) + 1)
+        if top_k > 0:
+            rows = ((after_prefix >= start) & (after_prefix < end)).nonzero().squeeze(1)
+            if len(rows) > 0:
+                top_lp[rows], top_ids[rows] = torch.topk(logprobs[rows, after_prefix[rows] - start], top_k, dim=-1)
+
+    target = torch.cat(targets, dim=1)
+    greedy = torch.cat(greedys, dim=1)
+    rank = torch.cat(ranks, dim=1)
+    return target, greedy, (top_lp, top_ids) if top_k > 0 else None, rank
+
+
+def _empty_results(n):
+    return {
+        "global_loss": [float("nan")] * n,
+        "suffix_loss": [float("nan")] * n,
+        "token_logprobs": [[] for _ in range(n)],
+        "token_ranks": [[] for _ in range(n)],
+        "token_start": [1] * n,
+        "topk_ids": [[] for _ in range(n)],
+        "topk_probs": [[] for _ in range(n)],
+        "token_exact_match": [0] * n,
+        "match_prefix_len": [0] * n,
+        "match_fraction": [0.0] * n,
+        "greedy_suffix_ids": [[] for _ in range(n)],
+    }
+
+
+def _prefix_tensor(bucket, prefix_lens, device):
+    return torch.tensor([prefix_lens[i] for i in bucket], device=device)
+
+
+def _fill_batch_metrics(results, bucket, stats, input_ids, attention_mask, token_ids, prefix_lens):
+    """
+    Turns the per-position statistics of a padded batch into per-canary metrics stored in results.
+    """
+    device = input_ids.device
+    target, greedy, top, rank = stats
+
+    # Target t + 1 belongs to the suffix when t + 1 >= prefix_len
+    target_pos = torch.arange(1, input_ids.size(1), device=device).unsqueeze(0)
+    lengths = attention_mask.sum(dim=1, keepdim=True)
+    prefix = _prefix_tensor(bucket, prefix_lens, device).unsqueeze(1)
+    global_mask = target_pos < lengths
+    suffix_mask = global_mask & (target_pos >= prefix)
+
+    losses = -target * global_mask
+    global_batch = losses.sum(dim=1) / global_mask.sum(dim=1)
+    suffix_batch = (losses * suffix_mask).sum(dim=1) / suffix_mask.sum(dim=1)
+
+    # Teacher-forced greedy extraction: padding and prefix positions count as matched
+    correct = (greedy == input_ids[:, 1:]) & suffix_mask
+    suffix_len = suffix_mask.sum(dim=1)
+    recovered = correct.sum(dim=1)
+    match_prefix = (correct | ~suffix_mask).long().cumprod(dim=1).sum(dim=1) - (prefix.squeeze(1) - 1).clamp(min=0)
+    match_prefix = match_prefix.clamp(min=0).minimum(suffix_len)
+    exact = (recovered == suffix_len) & (suffix_len > 0)
+    fraction = recovered / suffix_len.clamp(min=1)
+
+    for row, i in enumerate(bucket):
+        start = max(prefix_lens[i] - 1, 0)
+        results["greedy_suffix_ids"][i] = greedy[row, start:len(token_ids[i]) - 1].tolist()
+
+    for i, g_loss, s_loss, lp, rk, em, m_len, frac in zip(
+            bucket, global_batch.tolist(), suffix_batch.tolist(), target.tolist(), rank.tolist(),
+            exact.tolist(), match_prefix.tolist(), fraction.tolist()
+    ):
+        results["global_loss"][i] = g_loss
+        results["suffix_loss"][i] = s_loss
+        results["token_logprobs"][i] = lp[:len(token_ids[i]) - 1]
+        results["token_ranks"][i] = rk[:len(token_ids[i]) - 1]
+        results["token_exact_match"][i] = int(em)
+        results["match_prefix_len"][i] = m_len
+        results["match_fraction"][i] = frac
+
+    if top is not None:
+        top_lp, top_ids = top
+        for i, ids, probs in zip(bucket, top_ids.tolist(), top_lp.exp().tolist()):
+            results["topk_ids"][i] = ids
+            results["topk_probs"][i] = probs
+
+
+def _suffix_view(token_ids, prefix_lens):
+    """
+    Suffix-only view of every canary: the last prefix token followed by the suffix, with a
+    prefix length of 1. Scoring this view with the logits of those positions yields the same
+    suffix metrics as the full sequence.
+    """
+    view_ids = [ids[max(prefix_len - 1, 0):] for ids, prefix_len in zip(token_ids, prefix_lens)]
+    view_prefix = [min(prefix_len, 1) for prefix_len in prefix_lens]
+    return view_ids, view_prefix
+
+
+def _suffix_only_results(results, prefix_lens):
+    """
+    Marks results scored on the suffix view: no global loss, and the per-token lists
+    start at the first suffix target instead of target 1.
+    """
+    results["global_loss"] = [float("nan")] * len(prefix_lens)
+    results["token_start"] = [max(prefix_len - 1, 0) + 1 for prefix_len in prefix_lens]
+
+
+def score_canaries(model, token_ids, prefix_lens, pad_token_id, batch_size=16, top_k=0, suffix_only=False,
+                   chunk_size=None):
+    """
+    Computes all canary metrics from a single forward pass over the full sequence,
+    with length-bucketed, padded batches. Suffix loss, global loss, the per-token
+    target log-probs and (optionally) the top-k next tokens after the prefix are all
+    read from the same logits tensor. Results are returned in the original canary order.
+
+    The argmax of the same logits gives the teacher-forced greedy check: the suffix is
+    extracted exactly iff the argmax equals the target at every suffix position.
+    match_prefix_len counts the leading suffix tokens recovered and match_fraction
+    the share of suffix tokens recovered.
+
+    With suffix_only=True only the backbone runs over the full sequence and the LM head is
+    applied to the positions that predict a suffix token. The global loss is then not
+    available (NaN) and token_logprobs only covers the suffix. With chunk_size the LM head
+    is applied over chunks of positions instead of materializing all logits at once.
+
+    token_logprobs / token_ranks of canary i hold the targets token_start[i], token_start[i] + 1, ...
+    of its token ids; ranks are 1-based (1 = the target is the argmax).
+    """
+    results = _empty_results(len(token_ids))
+    _score_full_sequences(
+        model, results, range(len(token_ids)), token_ids, prefix_lens, pad_token_id, batch_size, top_k,
+        suffix_only, chunk_size,
+    )
+    if suffix_only:
+        _suffix_only_results(results, prefix_lens)
+    return results
+
+
+def _score_full_sequences(model, results, indices, token_ids, prefix_lens, pad_token_id, batch_size, top_k,
+                          suffix_only=False, chunk_size=None):
+    device = next(model.parameters()).device
+    indices = list(indices)
+    if suffix_only:
+        view_ids, view_prefix = _suffix_view(token_ids, prefix_lens)
+    else:
+        view_ids, view_prefix = token_ids, prefix_lens
+
+    for bucket in length_buckets([len(token_ids[i]) for i in indices], batch_size):
+        batch = [indices[j] for j in bucket]
+        input_ids, attention_mask = pad_batch([token_ids[i] for i in batch], pad_token_id, device)
+        if not suffix_only and chunk_size is None:
+            logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+            stats = logit_stats(logits, input_ids, _prefix_tensor(batch, prefix_lens, device), top_k)
+            _fill_batch_metrics(results, batch, stats, input_ids, attention_mask, token_ids, prefix_lens)
+            continue
+
+        hidden, _ = backbone_forward(model, input_ids, attention_mask)
+        batch_view_ids, batch_view_mask = pad_batch([view_ids[i] for i in batch], pad_token_id, device)
+        start = torch.tensor([len(token_ids[i]) - len(view_ids[i]) for i in batch], device=device)
+        positions = start.unsqueeze(1) + torch.arange(batch_view_ids.size(1), device=device)
+        view_hidden = gather_positions(hidden, positions.clamp(max=input_ids.size(1) - 1))
+        stats = chunked_logit_stats(
+            model, view_hidden, batch_view_ids, _prefix_tensor(batch, view_prefix, device), top_k, chunk_size
+        )
+        _fill_batch_metrics(results, batch, stats, batch_view_ids, batch_view_mask, view_ids, view_prefix)
+
+
+def prefix_groups(token_ids, prefix_lens):
+    """
+    Groups canary indices by their exact prefix token ids, in order of first appearance.
+    """
+    groups = {}
+    for i, (ids, prefix_len) in enumerate(zip(token_ids, prefix_lens)):
+        groups.setdefault(tuple(ids[:prefix_len]), []).append(i)
+    return groups
+
+
+def fork_prefix_cache(past_key_values, n):
+    """
+    Returns a copy of a batch-1 KV cache repeated n times along the batch dimension.
+    The original cache is left untouched so it can be forked again.
+    """
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(t.expand(n, *t.shape[1:]) for t in layer) for layer in past_key_values)
+    cache = copy.deepcopy(past_key_values)
+    cache.batch_repeat_interleave(n)
+    return cache
+
+
+def score_canaries_shared_prefix(model, token_ids, prefix_lens, pad_token_id, batch_size=16, top_k=0,
+                                 suffix_only=False, chunk_size=None):
+    """
+    Same metrics as score_canaries, but canaries sharing the same prefix tokens are scored
+    against a single prefix forward: its KV cache is computed once per group and forked
+    across the group's suffixes, which are then run in padded batches. Canaries with a
+    unique prefix gain nothing from the cache and go through the plain batched path.
+    """
+    device = next(model.parameters()).device
+    results = _empty_results(len(token_ids))
+    groups = prefix_groups(token_ids, prefix_lens)
+
+    singles = [members[0] for members in groups.values() if len(members) == 1]
+    _score_full_sequences(
+        model, results, singles, token_ids, prefix_lens, pad_token_id, batch_size, top_k, suffix_only, chunk_size
+    )
+
+    if suffix_only:
+        view_ids, view_prefix = _suffix_view(token_ids, prefix_lens)
+    else:
+        view_ids, view_prefix = token_ids, prefix_lens
+
+    for prefix_ids, members in groups.items():
+        if len(members) == 1:
+            continue
+        prefix_len = len(prefix_ids)
+        prefix_input = torch.tensor([prefix_ids], dtype=torch.long, device=device)
+        # Hidden states of the prefix positions kept in the view (only the last one when suffix_only)
+        prefix_hidden, past_key_values = backbone_forward(model, prefix_input, use_cache=True)
+        if suffix_only:
+            prefix_hidden = prefix_hidden[:, -1:]
+        prefix_view = prefix_input[:, -prefix_hidden.size(1):]
+
+        suffixes = [token_ids[i][prefix_len:] for i in members]
+        for bucket in length_buckets([len(s) for s in suffixes], batch_size):
+            batch = [members[j] for j in bucket]
+            hidden = prefix_hidden.expand(len(batch), -1, -1)
+            input_ids = prefix_view.expand(len(batch), -1)
+            prefix_mask = torch.ones((len(batch), prefix_len), dtype=torch.long, device=device)
+            attention_mask = prefix_mask[:, -prefix_view.size(1):]
+
+            if max(len(suffixes[j]) for j in bucket) > 0:
+                suffix_ids, suffix_mask = pad_batch([suffixes[j] for j in bucket], pad_token_id, device)
+                suffix_hidden, _ = backbone_forward(
+                    model, suffix_ids, torch.cat([prefix_mask, suffix_mask], dim=1),
+                    past_key_values=fork_prefix_cache(past_key_values, len(batch)), use_cache=True,
+                )
+                hidden = torch.cat([hidden, suffix_hidden], dim=1)
+                input_ids = torch.cat([input_ids, suffix_ids], dim=1)
+                attention_mask = torch.cat([attention_mask, suffix_mask], dim=1)
+
+            stats = chunked_logit_stats(
+                model, hidden, input_ids, _prefix_tensor(batch, view_prefix, device), top_k, chunk_size
+            )
+            _fill_batch_metrics(results, batch, stats, input_ids, attention_mask, view_ids, view_prefix)
+
+    if suffix_only:
+        _suffix_only_results(results, prefix_lens)
+    return results
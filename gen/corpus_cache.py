@@ -0,0 +1,161 @@
+import hashlib
+import os
+
+import numpy as np
+import pyarrow.compute as pc
+import torch
+
+from memorization.canary_set import tokenizer_fingerprint
+from canary_injection import IGNORE_INDEX
+from packing import block_plan, copy_blocks, document_offsets
+
+CACHE_VERSION = 2
+
+
+class PackedBlocks(torch.utils.data.Dataset):
+    """
+    Tokenized and grouped corpus of one split: block i is tokens[offsets[i]:offsets[i + 1]]
+    (every block has block_size tokens except, possibly, a short one when a whole group was
+    shorter than that). Items are the usual input_ids / attention_mask / labels dicts, labels
+    being the same list as input_ids. doc_offsets, when cached, are the positions in tokens
+    where documents begin.
+    """
+
+    def __init__(self, tokens, offsets, fingerprint, doc_offsets=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+        self.doc_offsets = doc_offsets
+        self.lengths = np.diff(offsets)
+        self.uniform = len(self.lengths) > 0 and bool((self.lengths == self.lengths[0]).all())
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        ids = self.tokens[self.offsets[i]:self.offsets[i + 1]].tolist()
+        return {"input_ids": ids, "attention_mask": [1] * len(ids), "labels": ids}
+
+    def __getitems__(self, indices, width=None):
+        """
+        A whole batch as [len(indices), width] int64 arrays (width defaults to the longest
+        block): a slice of the block view for consecutive indices, one fancy-indexing gather
+        otherwise. Short blocks are right-padded, the padding being masked out.
+        The int32 tokens are widened once per batch (the model needs int64 ids), which copies;
+        input_ids and labels then share that array.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        width = width or int(lengths.max(initial=0))
+        blocks = self.blocks
+        if blocks is not None and blocks.shape[1] == width:
+            if len(indices) > 1 and (np.diff(indices) == 1).all():
+                ids = blocks[indices[0]:indices[-1] + 1]
+            else:
+                ids = blocks[indices]
+            ids = ids.astype(np.int64, copy=False)
+            return {"input_ids": ids, "attention_mask": np.ones_like(ids), "labels": ids}
+
+        real = np.arange(width)[None, :] < lengths[:, None]
+        ids = np.zeros((len(indices), width), dtype=np.int64)
+        ids[real] = np.concatenate([self.tokens[self.offsets[i]:self.offsets[i + 1]] for i in indices] or [[]])
+        return {"input_ids": ids, "attention_mask": real.astype(np.int64), "labels": np.where(real, ids, IGNORE_INDEX)}
+
+    @property
+    def blocks(self):
+        """
+        [n_blocks, block_size] view of the tokens (no copy); None if some block is short.
+        """
+        if not self.uniform:
+            return None
+        return self.tokens[:self.offsets[-1]].reshape(len(self.lengths), int(self.lengths[0]))
+
+    def __getstate__(self):
+        # Worker processes reopen the memory map instead of receiving a copy of the corpus
+        state = dict(self.__dict__)
+        if isinstance(self.tokens, np.memmap):
+            state["tokens"] = (self.tokens.filename, self.tokens.offset, self.tokens.shape)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["tokens"], tuple):
+            filename, offset, shape = state["tokens"]
+            state["tokens"] = np.memmap(filename, dtype=np.int32, mode="r", offset=offset, shape=shape)
+        self.__dict__.update(state)
+
+    def select(self, indices):
+        return torch.utils.data.Subset(self, [int(i) for i in indices])
+
+
+class CorpusCache:
+    """
+    Tokenize-once cache of the packed base corpus, shared by every run on the same data.
+
+    Every split is stored as a flat int32 token file plus the block offsets (and optionally
+    the document offsets), keyed by the fingerprint of the raw split, the text column, the
+    tokenizer fingerprint, the block size and the packing mode, so the M_noC and M_C arms
+    (and any later run with the same tokenizer family) skip tokenization and packing.
+    Canaries are not part of it: they are added as separate blocks.
+    """
+
+    def __init__(self, cache_dir, raw_datasets, tokenizer, block_size, text_column, carry_remainder=False,
+                 doc_offsets=False):
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.group_size = None if carry_remainder else 1000
+        self.doc_offsets = doc_offsets
+        tok = tokenizer_fingerprint(tokenizer)
+        self.paths = {}
+        self.fingerprints = {}
+        for split, dataset in raw_datasets.items():
+            key = f"{dataset._fingerprint}|{text_column}|{tok}|{block_size}|{self.group_size}|{CACHE_VERSION}"
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+            self.fingerprints[split] = digest
+            self.paths[split] = {
+                part: os.path.join(cache_dir, f"{split}_{digest}.{part}.npy") for part in ("tokens", "offsets", "docs")
+            }
+
+    def _parts(self):
+        return ("tokens", "offsets", "docs") if self.doc_offsets else ("tokens", "offsets")
+
+    def missing(self):
+        return [
+            split for split, paths in self.paths.items()
+            if not all(os.path.exists(paths[part]) for part in self._parts())
+        ]
+
+    def pack(self, split, tokenized):
+        """
+        Packs the input_ids column of a tokenized datasets.Dataset into the cache, one Arrow
+        chunk in memory at a time: the block layout is planned from the document lengths alone
+        and the kept tokens are streamed into a memory-mapped file.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        column = tokenized.flatten_indices().data.column("input_ids")
+        doc_lengths = pc.list_value_length(column).to_numpy().astype(np.int64)
+        starts, lengths = block_plan(doc_lengths, self.block_size, self.group_size)
+        paths = self.paths[split]
+
+        tmp_tokens = f"{paths['tokens']}.{os.getpid()}.tmp.npy"
+        tokens = np.lib.format.open_memmap(tmp_tokens, mode="w+", dtype=np.int32, shape=(int(lengths.sum()),))
+        chunks = (pc.list_flatten(chunk).to_numpy(zero_copy_only=False) for chunk in column.chunks)
+        copy_blocks(chunks, starts, lengths, tokens)
+        tokens.flush()
+        del tokens
+        os.replace(tmp_tokens, paths["tokens"])
+
+        arrays = {"offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)}
+        if self.doc_offsets:
+            arrays["docs"] = document_offsets(doc_lengths, starts, lengths)
+        # Offsets are renamed last: a split only counts as cached once every file is complete
+        for part in sorted(arrays, key=lambda p: p == "offsets"):
+            tmp_path = f"{paths[part]}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, arrays[part])
+            os.replace(tmp_path, paths[part])
+
+    def load(self, split):
+        paths = self.paths[split]
+        return PackedBlocks(
+            np.load(paths["tokens"], mmap_mode="r"), np.load(paths["offsets"]), self.fingerprints[split],
+            np.load(paths["docs"]) if self.doc_offsets else None,
+        )
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+
+
+class EarlyStopper:
+    """
+    Stopping policy driven by the metrics run_clm already computes.
+
+    - em_patience: stop once the set of train-split canaries that are exactly extracted has not
+      changed for em_patience consecutive canary evaluations. Counting starts at the first
+      evaluation with at least one memorized canary, so the flat all-zero start does not count.
+    - ppl_patience: stop once validation perplexity has risen for ppl_patience consecutive epochs.
+    - stop_epoch: stop after this epoch regardless (e.g. the epoch another arm stopped at).
+
+    The decision is taken at epoch boundaries only, so every arm stops on the same epoch grid.
+    """
+
+    def __init__(self, em_patience=None, ppl_patience=None, stop_epoch=None):
+        self.em_patience = em_patience
+        self.ppl_patience = ppl_patience
+        self.stop_epoch = stop_epoch
+
+        self.last_em = None
+        self.em_stable = 0
+        self.last_perplexity = None
+        self.ppl_rising = 0
+        self.reason = None
+
+    def update_canaries(self, exact_matches, splits):
+        em = np.asarray(exact_matches)[np.asarray(splits) == "train"]
+        if self.last_em is not None and em.any() and np.array_equal(em, self.last_em):
+            self.em_stable += 1
+        else:
+            self.em_stable = 0
+        self.last_em = em
+
+    def update_perplexity(self, perplexity):
+        if self.last_perplexity is not None and perplexity > self.last_perplexity:
+            self.ppl_rising += 1
+        else:
+            self.ppl_rising = 0
+        self.last_perplexity = perplexity
+
+    def should_stop(self, epoch):
+        """
+        Checked at the end of each epoch; sets reason when training should stop.
+        """
+        if self.stop_epoch is not None and epoch >= self.stop_epoch:
+            self.reason = f"stop_epoch {self.stop_epoch} reached"
+        elif self.em_patience is not None and self.em_stable >= self.em_patience:
+            self.reason = f"train exact match stable for {self.em_stable} evaluations"
+        elif self.ppl_patience is not None and self.ppl_rising >= self.ppl_patience:
+            self.reason = f"validation perplexity rising for {self.ppl_rising} epochs"
+        return self.reason is not None
+
+    def save(self, path, epoch, step):
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump({"stopped_epoch": epoch, "step": step, "early_stopped": self.reason is not None,
+                       "reason": self.reason}, f, indent=2)
+
+
+def load_stop_epoch(path):
+    """
+    Last epoch trained by the run that wrote early_stop.json at path.
+    """
+    with open(path, mode="r", encoding="utf-8") as f:
+        return json.load(f)["stopped_epoch"]
@@ -0,0 +1,76 @@
+import math
+
+import numpy as np
+
+
+class AdaptiveEvalScheduler:
+    """
+    Decides at which optimizer steps the canaries are evaluated during an epoch.
+
+    Evaluations start every eval_steps steps. With adaptive=True the interval is halved
+    (down to eval_steps // 4) when the canary metrics move fast between two points -- an
+    exact-match flip, or a mean absolute suffix-loss change above change_tol per eval_steps
+    steps -- and doubled (up to 8 * eval_steps) when they plateau (change below change_tol / 4).
+
+    With budget set, the time spent in these evaluations is kept under budget times the
+    training time: the next point is pushed back until the projected overhead fits.
+    """
+
+    def __init__(self, eval_steps, adaptive=False, budget=None, change_tol=0.05):
+        self.eval_steps = eval_steps
+        self.adaptive = adaptive
+        self.budget = budget
+        self.change_tol = change_tol
+        self.min_interval = max(1, eval_steps // 4)
+        self.max_interval = eval_steps * 8
+
+        self.interval = eval_steps
+        self.next_step = eval_steps
+        self.last_step = 0
+        self.last_results = None
+        self.eval_seconds = 0.0
+        self.train_seconds = 0.0
+        self.train_steps = 0
+
+    def add_train_time(self, seconds, steps=1):
+        self.train_seconds += seconds
+        self.train_steps += steps
+
+    def should_eval(self, step):
+        return step >= self.next_step
+
+    def record(self, step, eval_seconds, results=None):
+        """
+        Registers an evaluation done at step (results: dict with suffix_loss and exact_match
+        lists, or None if not available yet) and returns the step of the next one.
+        """
+        self.eval_seconds += eval_seconds
+        if self.adaptive and results is not None and self.last_results is not None and step > self.last_step:
+            self.interval = self._adapt(step, results)
+        if results is not None:
+            self.last_results = results
+        self.last_step = step
+
+        interval = self.interval
+        if self.budget is not None and self.train_steps > 0 and self.train_seconds > 0:
+            step_seconds = self.train_seconds / self.train_steps
+            # Each point must be paid for by budget-fraction of the training in between...
+            interval = max(interval, math.ceil(eval_seconds / (self.budget * step_seconds)))
+            # ...and any overspend so far is recovered before the next one
+            deficit = self.eval_seconds / self.budget - self.train_seconds
+            if deficit > 0:
+                interval = max(interval, math.ceil(deficit / step_seconds))
+        self.next_step = step + interval
+        return self.next_step
+
+    def _adapt(self, step, results):
+        previous = self.last_results
+        change = np.nanmean(np.abs(np.asarray(results["suffix_loss"]) - np.asarray(previous["suffix_loss"])))
+        change = change * self.eval_steps / (step - self.last_step)
+        flips = int(np.sum(np.asarray(results["exact_match"]) != np.asarray(previous["exact_match"])))
+
+        if flips > 0 or change > self.change_tol:
+            return max(self.min_interval, self.interval // 2)
+        if change < self.change_tol / 4:
+            return min(self.max_interval, self.interval * 2)
+        return self.interval
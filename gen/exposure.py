@@ -0,0 +1,181 @@
+import math
+import string
+
+import numpy as np
+import torch
+from accelerate.utils import gather_object
+from scipy.stats import skewnorm
+
+from canary_scoring import score_canaries_shared_prefix
+from memorization.canary_set import CanarySet
+from mia_stats import stratified_sample
+
+CHARACTER_CLASSES = (string.digits, string.ascii_lowercase, string.ascii_uppercase, string.punctuation)
+# Alphabets the secrets of the canary generators are drawn from (generate_canaries.py and
+# generate_multi_condition_canaries.py: letters_digits; generate_easy_canaries.py: lowercase_digits)
+ALPHABETS = {
+    "digits": string.digits,
+    "lowercase_digits": string.ascii_lowercase + string.digits,
+    "letters_digits": string.ascii_letters + string.digits,
+}
+
+
+def _split_separator(secret):
+    # Single symbols separated by spaces ("4 0 1 9 2") are symbols "40192" with separator " "
+    if len(secret) > 1 and len(secret) % 2 == 1 and set(secret[1::2]) == {" "}:
+        return secret[::2], " "
+    return secret, ""
+
+
+class SecretSpace:
+    """
+    Every secret of a fixed number of symbols over an alphabet, the symbols optionally joined by
+    a separator (e.g. "4 0 1 9 2"). Candidate i is the base-len(alphabet) writing of i.
+    """
+
+    def __init__(self, alphabet, length, separator=""):
+        self.alphabet = "".join(dict.fromkeys(alphabet))
+        self.length = length
+        self.separator = separator
+        self.size = len(self.alphabet) ** length
+
+    @classmethod
+    def of(cls, secret, alphabet=None):
+        """
+        Space of the secret over the alphabet it was generated from: a name of ALPHABETS or the
+        characters themselves. Without an alphabet, falls back to infer().
+        """
+        if alphabet is None:
+            return cls.infer(secret)
+        alphabet = ALPHABETS.get(alphabet, alphabet)
+        symbols, separator = _split_separator(secret)
+        if not set(symbols) <= set(alphabet):
+            raise ValueError(f"Secret {secret!r} has symbols outside of the alphabet {alphabet!r}.")
+        return cls(alphabet, len(symbols), separator)
+
+    @classmethod
+    def infer(cls, secret):
+        """
+        Smallest union of character classes (digits, lowercase, uppercase, punctuation) holding
+        every symbol of the secret; single symbols separated by spaces are detected as such.
+        An estimate only: a secret need not use every class of the alphabet it was drawn from.
+        """
+        symbols, separator = _split_separator(secret)
+        alphabet = "".join(c for c in CHARACTER_CLASSES if set(c) & set(symbols))
+        alphabet += "".join(sorted(set(symbols) - set(alphabet)))
+        return cls(alphabet, len(symbols), separator)
+
+    def decode(self, indices):
+        """
+        Secrets of the given candidate indices (an int64 array).
+        """
+        digits = np.empty((len(indices), self.length), dtype=np.int64)
+        rest = np.asarray(indices, dtype=np.int64).copy()
+        for position in range(self.length - 1, -1, -1):
+            rest, digits[:, position] = np.divmod(rest, len(self.alphabet))
+        return self._join(digits)
+
+    def sample(self, num_samples, seed=0):
+        """
+        Seeded sample of secrets: stratified over the candidate indices (so every leading symbol
+        is represented proportionally), or uniform per symbol when the space is too large to be
+        indexed exactly.
+        """
+        if self.size <= 2 ** 53:
+            return self.decode(stratified_sample(self.size, num_samples, seed))
+        rng = np.random.default_rng(seed)
+        return self._join(rng.integers(0, len(self.alphabet), size=(num_samples, self.length)))
+
+    def _join(self, digits):
+        table = np.array(list(self.alphabet), dtype=object)
+        return [self.separator.join(row) for row in table[digits]]
+
+
+class ExposureEngine:
+    """
+    Exposure of one canary, prefix + " " + secret, against the other secrets of its space.
+
+    Candidates share the prefix, so they are scored in padded batches against a single prefix
+    KV cache, on the model's device and (with an accelerator) sharded across processes. The
+    score is the log-perplexity of the secret given the prefix (summed suffix-token NLL).
+
+    Spaces of at most max_exact secrets are enumerated, giving the exact rank and exposure
+    log2(|space|) - log2(rank). Larger ones use a fixed stratified sample of num_samples
+    candidates, the rank being extrapolated from it (and capped at the sample resolution, so
+    that exposure is at most log2(num_samples + 1)). The skew-normal approximation of the
+    candidate scores is reported as well; its fit is warm-started from the previous call.
+    The candidates are tokenized once, so repeated calls (one per epoch) only run the model.
+    """
+
+    def __init__(self, tokenizer, prefix, secret, space=None, num_samples=5000, max_exact=100_000, seed=0,
+                 batch_size=64):
+        self.tokenizer = tokenizer
+        self.space = space or SecretSpace.infer(secret)
+        self.batch_size = batch_size
+        self.exact = self.space.size <= max_exact
+
+        secrets = self.space.decode(np.arange(self.space.size)) if self.exact else self.space.sample(num_samples, seed)
+        self.secrets = [s for s in secrets if s != secret]
+        self.canary = self._tokenize([prefix], [secret])
+        self.candidates = self._tokenize([prefix] * len(self.secrets), self.secrets)
+        self.fit_params = None
+
+    def _tokenize(self, prefixes, secrets):
+        texts = CanarySet(list(range(len(secrets))), prefixes, [" " + s for s in secrets]).tokenize(self.tokenizer)
+        return texts.token_lists(), [int(p) for p in texts.prefix_lens]
+
+    def _scores(self, model, token_ids, prefix_lens):
+        if not token_ids:
+            return np.zeros(0)
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        results = score_canaries_shared_prefix(
+            model, token_ids, prefix_lens, pad_token_id, batch_size=self.batch_size, suffix_only=True
+        )
+        suffix_lens = np.array([len(ids) - p for ids, p in zip(token_ids, prefix_lens)])
+        return np.asarray(results["suffix_loss"], dtype=np.float64) * suffix_lens
+
+    def candidate_scores(self, model, accelerator=None):
+        token_ids, prefix_lens = self.candidates
+        if accelerator is None or accelerator.num_processes == 1:
+            return self._scores(model, token_ids, prefix_lens)
+        shard = np.array_split(np.arange(len(token_ids)), accelerator.num_processes)[accelerator.process_index]
+        local = self._scores(model, [token_ids[i] for i in shard], [prefix_lens[i] for i in shard])
+        return np.concatenate(gather_object([local]))
+
+    def exposure(self, model, accelerator=None):
+        """
+        Dict with the rank-based exposure (exact or sampled), the skew-normal estimate
+        (exposure_fit), the canary rank and log-perplexity and the size of the space.
+        """
+        model.eval()
+        with torch.no_grad():
+            canary_score = self._scores(model, *self.canary)[0]
+            scores = self.candidate_scores(model, accelerator)
+
+        lower = int((scores < canary_score).sum())
+        if self.exact:
+            rank = 1 + lower
+        else:
+            # A sample of n candidates cannot resolve ranks finer than size / (n + 1): beating every
+            # sampled candidate only bounds the exposure by log2(n + 1)
+            rank = 1 + (self.space.size - 1) * lower / max(len(scores), 1)
+            rank = max(rank, self.space.size / (len(scores) + 1))
+
+        if self.fit_params is None:
+            self.fit_params = skewnorm.fit(scores)
+        else:
+            a, loc, scale = self.fit_params
+            self.fit_params = skewnorm.fit(scores, a, loc=loc, scale=scale)
+        exposure_fit = -skewnorm.logcdf(canary_score, *self.fit_params) / math.log(2)
+
+        return {
+            "exposure": math.log2(self.space.size) - math.log2(rank),
+            "exposure_fit": float(exposure_fit),
+            "rank": rank,
+            "log_perplexity": float(canary_score),
+            "num_candidates": self.space.size,
+            "num_scored": len(scores),
+            "exact": self.exact,
+        }
@@ -0,0 +1,187 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+IGNORE_INDEX = -100
+
+
+def unwrap_causal_lm(model):
+    """
+    Strips DistributedDataParallel / PEFT wrappers and returns the underlying *ForCausalLM module.
+    """
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        model = model.module
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return model
+
+
+def get_lm_head(model):
+    """
+    Returns the vocabulary projection of the model.
+    """
+    model = unwrap_causal_lm(model)
+    if hasattr(model, "lm_head"):
+        # GPT-2, Llama, ecc.
+        return model.lm_head
+    if hasattr(model, "embed_out"):
+        # Pythia / GPT-NeoX
+        return model.embed_out
+    raise AttributeError("Could not find the model head (neither 'lm_head' nor 'embed_out').")
+
+
+def get_backbone(model):
+    """
+    Returns the transformer without its head ('transformer' on GPT-2, 'gpt_neox' on Pythia,
+    'model' on Llama-style models). Its output is already passed through the final norm.
+    """
+    model = unwrap_causal_lm(model)
+    return getattr(model, model.base_model_prefix)
+
+
+def get_decoder_layers(model):
+    """
+    Returns the list of transformer blocks ('h' on GPT-2, 'layers' on Pythia and Llama-style models).
+    """
+    backbone = get_backbone(model)
+    for name in ("h", "layers"):
+        if hasattr(backbone, name):
+            return getattr(backbone, name)
+    raise AttributeError("Could not find the transformer blocks (neither 'h' nor 'layers').")
+
+
+def get_final_norm(model):
+    """
+    Returns the norm applied to the output of the last block.
+    """
+    backbone = get_backbone(model)
+    for name in ("ln_f", "final_layer_norm", "norm"):
+        if hasattr(backbone, name):
+            return getattr(backbone, name)
+    raise AttributeError("Could not find the final norm (neither 'ln_f', 'final_layer_norm' nor 'norm').")
+
+
+def untie_lm_head(model):
+    """
+    Gives the head its own copy of the weights when they are tied to the input embeddings
+    (GPT-2), so that training the head leaves the embeddings untouched. Returns True if it was tied.
+    """
+    lm = unwrap_causal_lm(model)
+    head = get_lm_head(lm)
+    if head.weight is not lm.get_input_embeddings().weight:
+        return False
+    head.weight = torch.nn.Parameter(head.weight.detach().clone())
+    lm.config.tie_word_embeddings = False
+    return True
+
+
+def backbone_forward(model, input_ids, attention_mask=None, past_key_values=None, use_cache=False):
+    """
+    Runs the backbone only and returns (last_hidden_state, past_key_values).
+    """
+    outputs = get_backbone(model)(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        past_key_values=past_key_values,
+        use_cache=use_cache,
+    )
+    return outputs.last_hidden_state, outputs.past_key_values
+
+
+def gather_positions(hidden, positions):
+    """
+    Selects hidden states [batch, seq_len, dim] at positions [batch, n]; returns [batch, n, dim].
+    """
+    index = positions.unsqueeze(-1).expand(-1, -1, hidden.size(-1))
+    return hidden.gather(1, index)
+
+
+def final_hidden_states(model, input_ids, attention_mask=None):
+    """
+    Final (normed) hidden states of the full model call. Going through the top-level forward
+    keeps DDP / PEFT wrappers in the loop, while logits_to_keep=1 makes the head project a
+    single position only.
+    """
+    outputs = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        output_hidden_states=True,
+        logits_to_keep=1,
+        use_cache=False,
+    )
+    return outputs.hidden_states[-1]
+
+
+def _chunk_cross_entropy(head, hidden, labels):
+    logits = head(hidden).float()
+    losses = F.cross_entropy(
+        logits.reshape(-1, logits.size(-1)), labels.reshape(-1), ignore_index=IGNORE_INDEX, reduction="none"
+    )
+    return losses.view(labels.shape)
+
+
+def chunked_token_losses(model, hidden, labels, chunk_size=128):
+    """
+    Per-token next-token cross entropy [batch, seq_len - 1] (0 where the label is -100),
+    computed over chunks of chunk_size positions so that at most [batch, chunk_size, vocab]
+    logits exist at a time. When gradients are enabled each chunk is checkpointed, so its
+    logits are recomputed in backward instead of being kept alive.
+    """
+    head = get_lm_head(model)
+    hidden = hidden[:, :-1]
+    labels = labels[:, 1:]
+    chunks = []
+    for start in range(0, hidden.size(1), chunk_size):
+        h = hidden[:, start:start + chunk_size]
+        y = labels[:, start:start + chunk_size]
+        if torch.is_grad_enabled():
+            chunks.append(checkpoint(_chunk_cross_entropy, head, h, y, use_reentrant=False))
+        else:
+            chunks.append(_chunk_cross_entropy(head, h, y))
+    return torch.cat(chunks, dim=1)
+
+
+def causal_lm_loss(model, batch, chunk_size=None, token_mask=None):
+    """
+    Mean next-token loss of a batch, as model(**batch).loss. With chunk_size the full logits
+    are never materialized (see chunked_token_losses). Only the model inputs of the batch are
+    passed to the model, so extra columns (e.g. canary tags) can travel with it.
+
+    With token_mask, a [batch, seq_len - 1] bool mask over next-token targets, also returns
+    the detached per-token losses at those positions (in row-major order), computed from the
+    logits / hidden states of the same forward pass.
+    """
+    inputs = {k: batch[k] for k in ("input_ids", "attention_mask", "labels") if k in batch}
+    if chunk_size is None:
+        outputs = model(**inputs)
+        if token_mask is None:
+            return outputs.loss
+        with torch.no_grad():
+            logits = outputs.logits[:, :-1][token_mask].float()
+            token_losses = F.cross_entropy(logits, batch["labels"][:, 1:][token_mask], reduction="none")
+        return outputs.loss, token_losses
+    hidden = final_hidden_states(model, inputs["input_ids"], inputs.get("attention_mask"))
+    losses = chunked_token_losses(model, hidden, inputs["labels"], chunk_size)
+    loss = losses.sum() / (inputs["labels"][:, 1:] != IGNORE_INDEX).sum()
+    if token_mask is None:
+        return loss
+    return loss, losses.detach()[token_mask]
+
+
+def sequence_losses(model, batch, chunk_size=None):
+    """
+    Per-example mean next-token loss [batch] (over the non-ignored labels of each row), from
+    reduction='none' token losses; the per-example counterpart of causal_lm_loss.
+    """
+    labels = batch["labels"]
+    if chunk_size is None:
+        logits = model(input_ids=batch["input_ids"], attention_mask=batch.get("attention_mask")).logits
+        token_losses = F.cross_entropy(
+            logits[:, :-1].float().reshape(-1, logits.size(-1)), labels[:, 1:].reshape(-1),
+            ignore_index=IGNORE_INDEX, reduction="none",
+        ).view(labels.size(0), -1)
+    else:
+        hidden = final_hidden_states(model, batch["input_ids"], batch.get("attention_mask"))
+        token_losses = chunked_token_losses(model, hidden, labels, chunk_size)
+    counts = (labels[:, 1:] != IGNORE_INDEX).sum(dim=1).clamp(min=1)
+    return token_losses.sum(dim=1) / counts
@@ -0,0 +1,169 @@
+import csv
+import hashlib
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def normalize_canary(raw_prefix, raw_suffix):
+    """
+    Applies the whitespace normalization used for every canary:
+    no trailing space on the prefix and exactly one leading space on the suffix.
+    """
+    prefix = raw_prefix.rstrip()
+    suffix = " " + raw_suffix.lstrip()
+    return prefix, suffix
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of everything that determines how the tokenizer splits text (vocabulary, merges,
+    normalizer and special-token post-processing), independent of the name it was loaded from.
+    """
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = repr((type(tokenizer).__name__, sorted(tokenizer.get_vocab().items()), tokenizer.all_special_tokens))
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()[:16]
+
+
+class CanarySet:
+    """
+    The canaries of one experiment, stored column-wise.
+
+    Metadata (ids, split, repetitions, type, complexity) are numpy arrays; prefixes and
+    suffixes are kept already normalized, so prefix + suffix is exactly the text that is
+    injected into training and scored. After tokenize() the token ids of all canaries live
+    in one flat buffer: canary i is token_ids[offsets[i]:offsets[i + 1]] and its first
+    prefix_lens[i] tokens are the prefix.
+    """
+
+    def __init__(self, ids, prefixes, suffixes, splits=None, repetitions=None, types=None, complexities=None):
+        n = len(ids)
+        self.ids = np.asarray(ids, dtype=object)
+        self.prefixes = np.asarray(prefixes, dtype=object)
+        self.suffixes = np.asarray(suffixes, dtype=object)
+        self.splits = np.asarray(splits if splits is not None else ["train"] * n, dtype=object)
+        self.repetitions = np.asarray(repetitions if repetitions is not None else [1] * n, dtype=np.int64)
+        self.types = np.asarray(types if types is not None else [""] * n, dtype=object)
+        self.complexities = np.asarray(complexities if complexities is not None else [""] * n, dtype=object)
+
+        self.token_ids = None
+        self.offsets = None
+        self.prefix_lens = None
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Reads a canary CSV (canary_id, prefix, suffix and optionally repetitions, split,
+        type, complexity). A missing split means 'train'; invalid repetitions count as 1.
+        """
+        columns = {k: [] for k in ("ids", "prefixes", "suffixes", "splits", "repetitions", "types", "complexities")}
+        with open(path, mode="r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                prefix, suffix = normalize_canary(row["prefix"], row["suffix"])
+                try:
+                    reps = int(row.get("repetitions", "1"))
+                except ValueError:
+                    reps = 1
+                columns["ids"].append(row["canary_id"])
+                columns["prefixes"].append(prefix)
+                columns["suffixes"].append(suffix)
+                columns["splits"].append(row.get("split", "train"))
+                columns["repetitions"].append(max(reps, 0))
+                columns["types"].append(row.get("type", ""))
+                columns["complexities"].append(row.get("complexity", ""))
+        return cls(**columns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def full_texts(self):
+        return [p + s for p, s in zip(self.prefixes, self.suffixes)]
+
+    def metadata(self):
+        """
+        Per-canary metadata as a dict of columns (e.g. for pd.DataFrame).
+        """
+        return {
+            "canary_id": self.ids,
+            "split": self.splits,
+            "repetitions": self.repetitions,
+            "type": self.types,
+            "complexity": self.complexities,
+        }
+
+    def subset(self, indices):
+        """
+        New CanarySet with the given canaries, in the given order (token buffers included).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sub = CanarySet(
+            self.ids[indices], self.prefixes[indices], self.suffixes[indices], self.splits[indices],
+            self.repetitions[indices], self.types[indices], self.complexities[indices],
+        )
+        if self.token_ids is not None:
+            lengths = self.offsets[indices + 1] - self.offsets[indices]
+            sub.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            sub.token_ids = (
+                np.concatenate([self.token_ids[self.offsets[i]:self.offsets[i + 1]] for i in indices])
+                if len(indices) else np.zeros(0, dtype=self.token_ids.dtype)
+            )
+            sub.prefix_lens = self.prefix_lens[indices]
+        return sub
+
+    def tokenize(self, tokenizer, max_length=512, cache_dir=None):
+        """
+        Fills the token buffers: every full text is tokenized with special tokens (truncated
+        to max_length), and prefix_lens come from tokenizing the prefix on its own.
+        With cache_dir the buffers are stored in / loaded from a .npz keyed by the canary
+        texts, the tokenizer fingerprint and max_length.
+        """
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"canaries_{self.cache_key(tokenizer, max_length)}.npz")
+            if os.path.exists(cache_path):
+                with np.load(cache_path) as cached:
+                    self.token_ids = cached["token_ids"]
+                    self.offsets = cached["offsets"]
+                    self.prefix_lens = cached["prefix_lens"]
+                return self
+
+        sequences = tokenizer(self.full_texts(), truncation=True, max_length=max_length, add_special_tokens=True)
+        prefixes = tokenizer(list(self.prefixes), add_special_tokens=True)
+        lengths = [len(ids) for ids in sequences["input_ids"]]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.token_ids = np.fromiter(
+            (t for ids in sequences["input_ids"] for t in ids), dtype=np.int32, count=int(self.offsets[-1])
+        )
+        self.prefix_lens = np.array([len(ids) for ids in prefixes["input_ids"]], dtype=np.int32)
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename, so that concurrent processes never read a partial file.
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, token_ids=self.token_ids, offsets=self.offsets, prefix_lens=self.prefix_lens)
+            os.replace(tmp_path, cache_path)
+        return self
+
+    def cache_key(self, tokenizer, max_length):
+        content = hashlib.sha1()
+        for text in self.full_texts():
+            content.update(text.encode("utf-8"))
+            content.update(b"\0")
+        for prefix in self.prefixes:
+            content.update(prefix.encode("utf-8"))
+            content.update(b"\0")
+        content.update(f"{tokenizer_fingerprint(tokenizer)}|{max_length}|{CACHE_VERSION}".encode("utf-8"))
+        return content.hexdigest()[:16]
+
+    def canary_tokens(self, i):
+        return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def token_lists(self):
+        """
+        Token ids of every canary as a list of python lists (the format of the scorers).
+        """
+        return [self.canary_tokens(i).tolist() for i in range(len(self))]
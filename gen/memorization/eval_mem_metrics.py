@@ -3,6 +3,11 @@ import os
 import pandas as pd
 import numpy as np
 import sys
+import zlib
+
+from canary_set import CanarySet
+from roc import DEFAULT_FPRS, roc_metrics
+from token_store import TokenStore
 
 
 def parse_args():
@@ -10,6 +15,18 @@ def parse_args():
     parser.add_argument("--loss_noC_csv", type=str, required=True, help="Path to M_noC logs (Reference).")
     parser.add_argument("--loss_C_csv", type=str, required=True, help="Path to M_C logs (Target).")
     parser.add_argument("--output_dir", type=str, required=True, help="Directory to save results.")
+    parser.add_argument("--canaries_csv", type=str, default=None,
+                        help="Canary CSV of the run. If given, its split/repetitions/type/complexity are used.")
+    parser.add_argument("--tokenizer_name", type=str, default=None,
+                        help="Tokenizer of the run (name or path). With --canaries_csv, gives the suffix token counts of the zlib score.")
+    parser.add_argument("--tokens_C_dir", type=str, default=None,
+                        help="canary_tokens/ store of the M_C run (--canary_token_store), for per-token scores.")
+    parser.add_argument("--min_k", type=float, default=0.2,
+                        help="Fraction of lowest-probability suffix tokens averaged by the Min-K%% score.")
+    parser.add_argument("--fprs", type=float, nargs="+", default=list(DEFAULT_FPRS),
+                        help="False positive rates at which TPR is reported (10%% is always included).")
+    parser.add_argument("--roc_strata", type=str, nargs="*", default=["repetitions", "type", "complexity"],
+                        help="Canary columns whose values get their own ROC (train canaries of the value vs all validation canaries).")
     return parser.parse_args()
 
 
@@ -39,6 +56,27 @@ def load_and_validate_data(filepath):
     if 'exact_match' not in df.columns:
         print(f"WARNING: 'exact_match' column not found in {filepath}. Biderman metric will be 0.")
 
+    # Older logs have one evaluation per epoch and no step column
+    if 'step' not in df.columns:
+        df.insert(1, 'step', df['epoch'])
+        df.attrs['has_steps'] = False
+    else:
+        df.attrs['has_steps'] = True
+
+    return df
+
+
+def add_progress(df):
+    """
+    Adds 'progress': training progress of every evaluation point in epochs (epoch e ends at
+    e + 1), interpolated on optimizer steps inside the epoch. Runs with a different number of
+    steps per epoch (M_C has the injected canaries on top of M_noC's data) line up on it.
+    """
+    ends = df.groupby('epoch')['step'].max().sort_index()
+    starts = ends.shift(1, fill_value=0)
+    start = df['epoch'].map(starts)
+    length = (df['epoch'].map(ends) - start).replace(0, 1)
+    df['progress'] = df['epoch'] + (df['step'] - start) / length
     return df
 
 
@@ -66,49 +104,201 @@ def calculate_dynamic_threshold(scores, fpr_target=0.10):
     return np.percentile(scores, percentile)
 
 
-def compute_scores(df_tgt, df_ref, df_opt):
-    """
-    Merges dataframes and calculates scores.
-    Applies clipping (ReLU) to ensure that if the target loss is worse
-    than the reference/optimum, the score is 0 (not negative).
-    """
-    print("   -> Merging data and computing scores...")
+# --- SCORER REGISTRY ---
+# Every scorer maps the merged frame (one row per epoch x canary) to one membership score per
+# row, higher meaning "more likely trained on". `requires` lists the frame columns or extra
+# inputs (e.g. 'suffix_logprobs') it needs; scorers whose inputs are missing are skipped.
+SCORERS = {}
 
-    # 1. Merge Target con Reference per l'epoca corrente
-    df_merged = pd.merge(
-        df_tgt,
-        df_ref[['epoch', 'canary_id', 'suffix_loss', 'global_loss']],
-        on=['epoch', 'canary_id'],
-        suffixes=('_tgt', '_ref'),  # Corretto: suffixes deve essere una tupla
-        how='inner'
-    )
 
-    # 2. Merge con la loss ottimale (minimo storico del Reference)
-    df_merged = pd.merge(df_merged, df_opt, on="canary_id", how="left")
+def register_scorer(name, requires=()):
+    def wrap(fn):
+        SCORERS[name] = (fn, tuple(requires))
+        return fn
+    return wrap
 
-    # --- CALCOLO METRICHE CON CLIPPING ---
 
+@register_scorer("mia_score", requires=("suffix_loss_ref", "suffix_loss_tgt"))
+def reference_difference(df, extra):
     # MIA Score = Loss_Ref - Loss_Tgt
-    df_merged['mia_score'] = df_merged['suffix_loss_ref'] - df_merged['suffix_loss_tgt']
+    return df['suffix_loss_ref'].values - df['suffix_loss_tgt'].values
+
 
+@register_scorer("counterfactual_score", requires=("suffix_loss_ref", "suffix_loss_tgt"))
+def counterfactual(df, extra):
     # Counterfactual = (Loss_Ref - Loss_Tgt) / Loss_Ref
     # Usiamo .clip(lower=0) per azzerare i valori dove il target è peggiore del reference
-    cf_raw = (df_merged['suffix_loss_ref'] - df_merged['suffix_loss_tgt']) / df_merged['suffix_loss_ref']
-    df_merged['counterfactual_score'] = cf_raw.clip(lower=0)
+    ref, tgt = df['suffix_loss_ref'].values, df['suffix_loss_tgt'].values
+    return np.clip((ref - tgt) / ref, 0, None)
 
+
+@register_scorer("contextual_score", requires=("loss_optimum", "suffix_loss_tgt"))
+def contextual(df, extra):
     # Contextual (Strict) = (Loss_Optimum - Loss_Tgt) / Loss_Optimum
     # Questo è il punto chiave per l'Epoca 0:
     # se la loss attuale è più alta del minimo storico, il risultato è 0.
-    ctx_raw = (df_merged['loss_optimum'] - df_merged['suffix_loss_tgt']) / df_merged['loss_optimum']
-    df_merged['contextual_score'] = ctx_raw.clip(lower=0)
+    opt, tgt = df['loss_optimum'].values, df['suffix_loss_tgt'].values
+    return np.clip((opt - tgt) / opt, 0, None)
+
+
+@register_scorer("loss_score", requires=("suffix_loss_tgt",))
+def target_loss(df, extra):
+    # LOSS attack (Yeom et al.): low target loss means member
+    return -df['suffix_loss_tgt'].values
+
+
+@register_scorer("ref_ratio_score", requires=("suffix_loss_ref", "suffix_loss_tgt"))
+def reference_ratio(df, extra):
+    # Reference attack, ratio form (Carlini et al. 2021): Loss_Ref / Loss_Tgt
+    return df['suffix_loss_ref'].values / df['suffix_loss_tgt'].values
+
+
+@register_scorer("zlib_score", requires=("zlib_len", "suffix_tokens", "suffix_loss_tgt"))
+def zlib_ratio(df, extra):
+    # zlib attack (Carlini et al. 2021): log-perplexity of the suffix (mean loss x suffix tokens)
+    # normalized by its zlib entropy
+    return -df['suffix_loss_tgt'].values * df['suffix_tokens'].values / df['zlib_len'].values
+
+
+@register_scorer("min_k_score", requires=("suffix_logprobs",))
+def min_k_prob(df, extra):
+    # Min-K% Prob (Shi et al. 2024): mean log-prob of the k% least likely suffix tokens
+    logprobs = extra['suffix_logprobs']
+    lengths = (~np.isnan(logprobs)).sum(axis=1)
+    ascending = np.sort(np.where(np.isnan(logprobs), np.inf, logprobs), axis=1)
+    cumulative = np.cumsum(np.where(np.isinf(ascending), 0.0, ascending), axis=1)
+    n_k = np.maximum(np.ceil(extra['min_k'] * lengths), 1).astype(np.int64)
+    if cumulative.shape[1] == 0:
+        return np.full(len(df), np.nan)
+    scores = np.take_along_axis(cumulative, np.minimum(n_k, cumulative.shape[1])[:, None] - 1, axis=1)[:, 0] / n_k
+    return np.where(lengths > 0, scores, np.nan)
+
+
+def zlib_lengths(canaries):
+    """
+    Size in bytes of the zlib-compressed suffix of every canary and, once the canaries are
+    tokenized, the number of suffix tokens the suffix loss is averaged over.
+    """
+    df = pd.DataFrame({
+        'canary_id': canaries.ids,
+        'zlib_len': [len(zlib.compress(s.strip().encode("utf-8"))) for s in canaries.suffixes],
+    })
+    if canaries.token_ids is not None:
+        df['suffix_tokens'] = np.clip(np.diff(canaries.offsets) - canaries.prefix_lens, 0, None)
+    return df
+
+
+def load_suffix_logprobs(tokens_dir, df):
+    """
+    Suffix target log-probs of the rows of df (matched on epoch, step, canary_id) from a token store,
+    as a NaN-padded [len(df), max_suffix_len] matrix gathered in one vectorized read.
+    """
+    store = TokenStore(tokens_dir)
+    keys = ['epoch', 'step', 'canary_id'] if 'step' in store.index.columns else ['epoch', 'canary_id']
+    rows = pd.merge(
+        df[keys].reset_index(drop=True).reset_index(),
+        store.index.drop_duplicates(keys, keep='last'),
+        on=keys, how='left',
+    ).sort_values('index')
+    found = rows['offset'].notna().values
+    skip = np.clip(rows['prefix_len'].fillna(0).values - rows['start'].fillna(0).values, 0, None)
+    lengths = np.where(found, np.clip(rows['length'].fillna(0).values - skip, 0, None), 0).astype(np.int64)
+    begin = np.where(found, rows['offset'].fillna(0).values + skip, 0).astype(np.int64)
+
+    width = int(lengths.max()) if len(lengths) else 0
+    columns = np.arange(width)
+    valid = columns[None, :] < lengths[:, None]
+    positions = np.where(valid, begin[:, None] + columns[None, :], 0)
+    values = np.asarray(store.logprobs[positions.ravel()] if positions.size else [], dtype=np.float64)
+    return np.where(valid, values.reshape(positions.shape), np.nan)
+
+
+def compute_scores(df_tgt, df_ref, df_opt, extra=None):
+    """
+    Merges dataframes and calculates every registered score that has its inputs.
+    Clipped scores (counterfactual, contextual) are 0 if the target loss is worse
+    than the reference/optimum (not negative).
+    """
+    print("   -> Merging data and computing scores...")
+    extra = extra or {}
+
+    # 1. Merge Target con Reference per l'epoca corrente
+    if df_tgt.attrs.get('has_steps') and df_ref.attrs.get('has_steps'):
+        # Step-level logs: every target point takes the reference point closest in training progress
+        df_tgt, df_ref = add_progress(df_tgt.copy()), add_progress(df_ref.copy())
+        df_merged = pd.merge_asof(
+            df_tgt.sort_values('progress'),
+            df_ref[['progress', 'canary_id', 'suffix_loss', 'global_loss']].sort_values('progress'),
+            on='progress',
+            by='canary_id',
+            suffixes=('_tgt', '_ref'),
+            direction='nearest',
+        ).dropna(subset=['suffix_loss_ref']).sort_values(['epoch', 'step']).reset_index(drop=True)
+    else:
+        df_merged = pd.merge(
+            df_tgt,
+            df_ref[['epoch', 'canary_id', 'suffix_loss', 'global_loss']],
+            on=['epoch', 'canary_id'],
+            suffixes=('_tgt', '_ref'),  # Corretto: suffixes deve essere una tupla
+            how='inner'
+        )
+
+    # 2. Merge con la loss ottimale (minimo storico del Reference)
+    df_merged = pd.merge(df_merged, df_opt, on="canary_id", how="left")
+    if 'zlib_lengths' in extra:
+        df_merged = pd.merge(df_merged, extra['zlib_lengths'], on="canary_id", how="left")
+    if 'tokens_dir' in extra:
+        extra['suffix_logprobs'] = load_suffix_logprobs(extra['tokens_dir'], df_merged)
+
+    # --- CALCOLO METRICHE ---
+    for name, (scorer, requires) in SCORERS.items():
+        if all(r in df_merged.columns or extra.get(r) is not None for r in requires):
+            df_merged[name] = scorer(df_merged, extra)
+        else:
+            print(f"   -> Skipping {name}: missing {[r for r in requires if r not in df_merged.columns]}")
 
     return df_merged
 
 
-def analyze_epoch(df_epoch, epoch):
+def roc_table(df, score_names, fprs=DEFAULT_FPRS, strata=()):
+    """
+    ROC of every score at every evaluation point, with train canaries as members and validation
+    canaries as non-members: overall (stratum 'all') and for every value of the strata columns
+    (the train canaries with that value vs all validation canaries). Computed in one roc_metrics call.
+    """
+    strata = [c for c in strata if c in df.columns]
+    long = df[df['split'].isin(['train', 'validation'])].melt(
+        id_vars=['epoch', 'step', 'split', *strata], value_vars=score_names, var_name='score', value_name='value'
+    ).dropna(subset=['value'])
+
+    parts = [long.assign(stratum='all')]
+    members, nonmembers = long[long['split'] == 'train'], long[long['split'] == 'validation']
+    for column in strata:
+        for value in members[column].dropna().unique():
+            parts.append(members[members[column] == value].assign(stratum=f"{column}={value}"))
+            parts.append(nonmembers.assign(stratum=f"{column}={value}"))
+    long = pd.concat(parts, ignore_index=True)
+
+    keys = ['epoch', 'step', 'score', 'stratum']
+    grouped = long.groupby(keys, sort=True)
+    roc = roc_metrics(long['value'].values, (long['split'] == 'train').values, grouped.ngroup().values, fprs)
+
+    table = grouped.size().reset_index()[keys]
+    table['auc'] = roc['auc']
+    for k, fpr in enumerate(fprs):
+        table[f'tpr_at_{fpr:g}'] = roc['tpr'][:, k]
+        table[f'threshold_at_{fpr:g}'] = roc['threshold'][:, k]
+    table['n_members'] = roc['n_members']
+    table['n_nonmembers'] = roc['n_nonmembers']
+    return table
+
+
+def analyze_epoch(df_epoch, epoch, step=None, roc=None, fprs=DEFAULT_FPRS):
     """
-    Analyzes a single epoch:
-    1. Calibrates Threshold on Validation Data.
+    Analyzes a single evaluation point (an epoch, or a step inside it):
+    1. Calibrates Threshold on Validation Data (interpolated 90th percentile, as in earlier
+       results); AUC and TPR at each FPR (order-statistic thresholds) are read from roc, the
+       'all' stratum rows of roc_table for this point, indexed by score.
     2. Computes Recall/Avg Scores on Training Data.
     3. Computes Average Perplexity on Training Data.
     """
@@ -117,7 +307,7 @@ def analyze_epoch(df_epoch, epoch):
     train_data = df_epoch[df_epoch['split'] == 'train']
 
     # Check if data exists
-    if len(val_data) == 0 or len(train_data) == 0:
+    if len(val_data) == 0 or len(train_data) == 0 or roc is None or 'mia_score' not in roc.index:
         return None
 
     # 1. Calibrate Threshold (MIA)
@@ -125,9 +315,12 @@ def analyze_epoch(df_epoch, epoch):
 
     # 2. Compute Metrics (on Training Set)
 
-    # A. MIA Recall (Binary)
+    # A. MIA Recall (Binary); mia_tpr_at_<fpr> are the exact ROC rates
     memorized_count = (train_data['mia_score'] > threshold_tau).sum()
     mia_recall = memorized_count / len(train_data)
+    mia_roc = {'mia_auc': roc.at['mia_score', 'auc']}
+    for fpr in fprs:
+        mia_roc[f'mia_tpr_at_{fpr:g}'] = roc.at['mia_score', f'tpr_at_{fpr:g}']
 
     # B. Biderman Exact Match (Binary)
     if 'exact_match' in train_data.columns:
@@ -135,6 +328,12 @@ def analyze_epoch(df_epoch, epoch):
     else:
         exact_match = 0.0
 
+    # Partial extraction: share of suffix tokens recovered under teacher forcing
+    if 'match_fraction' in train_data.columns:
+        avg_match_fraction = train_data['match_fraction'].mean()
+    else:
+        avg_match_fraction = float('nan')
+
     # C. Average Continuous Scores (Ghosh)
     avg_ctx = train_data['contextual_score'].mean()
     avg_cf = train_data['counterfactual_score'].mean()
@@ -143,15 +342,30 @@ def analyze_epoch(df_epoch, epoch):
     avg_loss = train_data['suffix_loss_tgt'].mean()
     avg_perplexity = np.exp(avg_loss)
 
+    # E. Recall of every other registered score, calibrated on Validation the same way,
+    #    with its ROC TPR at 10% FPR and AUC
+    score_recalls = {}
+    for name in SCORERS:
+        if name in ('mia_score', 'counterfactual_score', 'contextual_score') or name not in roc.index:
+            continue
+        tau = calculate_dynamic_threshold(val_data[name].dropna().values, fpr_target=0.10)
+        score_recalls[f'recall_{name}'] = (train_data[name] > tau).sum() / len(train_data)
+        score_recalls[f'tpr_at_0.1_{name}'] = roc.at[name, 'tpr_at_0.1']
+        score_recalls[f'auc_{name}'] = roc.at[name, 'auc']
+
     return {
         'epoch': epoch,
+        'step': step,
         'mia_threshold_tau': threshold_tau,
         'mia_recall': mia_recall,
+        **mia_roc,
         'exact_match': exact_match,
+        'avg_match_fraction': avg_match_fraction,
         'avg_counterfactual_score': avg_cf,
         'avg_contextual_score': avg_ctx,
         'avg_perplexity': avg_perplexity,  # <--- Salviamo questo dato
-        'n_train_samples': len(train_data)
+        'n_train_samples': len(train_data),
+        **score_recalls,
     }
 
 def main():
@@ -185,29 +399,59 @@ def main():
     df_opt = compute_optimal_contextual_loss(df_ref)
 
     print("--- 3. COMPUTING SCORES ---")
-    df_processed = compute_scores(df_tgt, df_ref, df_opt)
+    extra = {'min_k': args.min_k}
+    if args.canaries_csv is not None:
+        canaries = CanarySet.from_csv(args.canaries_csv)
+        # A canary set of another run would leave every split empty and the summary with it
+        logged = pd.unique(pd.concat([df_tgt['canary_id'], df_ref['canary_id']]).astype(str))
+        unknown = sorted(set(logged) - set(canaries.ids.astype(str)))
+        if unknown:
+            print(f"ERROR: {len(unknown)} of {len(logged)} logged canary ids are not in {args.canaries_csv}: "
+                  f"{unknown[:10]}{' ...' if len(unknown) > 10 else ''}")
+            sys.exit(1)
+        if args.tokenizer_name is not None:
+            from transformers import AutoTokenizer
+            canaries.tokenize(AutoTokenizer.from_pretrained(args.tokenizer_name))
+        extra['zlib_lengths'] = zlib_lengths(canaries)
+    if args.tokens_C_dir is not None:
+        extra['tokens_dir'] = args.tokens_C_dir
+    df_processed = compute_scores(df_tgt, df_ref, df_opt, extra)
+
+    if args.canaries_csv is not None:
+        # The canary set is the authority on split and metadata, not the columns copied into the logs
+        df_meta = pd.DataFrame(canaries.metadata())
+        df_processed = df_processed.drop(columns=[c for c in df_meta.columns if c != 'canary_id' and c in df_processed])
+        df_processed = pd.merge(df_processed, df_meta, on='canary_id', how='left')
 
     print("--- 4. RUNNING EPOCH ANALYSIS ---")
-    results = []
-    epochs = sorted(df_processed['epoch'].unique())
+    # ROC of every score, evaluation point and stratum at once
+    fprs = sorted(set(args.fprs) | {0.1}, reverse=True)
+    score_names = [name for name in SCORERS if name in df_processed.columns]
+    df_roc = roc_table(df_processed, score_names, fprs, args.roc_strata)
+    roc_overall = df_roc[df_roc['stratum'] == 'all'].set_index(['epoch', 'step', 'score'])
 
-    for epoch in epochs:
-        df_epoch = df_processed[df_processed['epoch'] == epoch]
-        stats = analyze_epoch(df_epoch, epoch)
+    results = []
+    # One analysis per evaluation point (several per epoch with --eval_steps)
+    for (epoch, step), df_epoch in df_processed.groupby(['epoch', 'step'], sort=True):
+        roc = roc_overall.loc[(epoch, step)] if (epoch, step) in roc_overall.index.droplevel('score') else None
+        stats = analyze_epoch(df_epoch, epoch, step, roc, fprs)
 
         if stats:
             print(
-                f"Epoch {epoch}: MIA={stats['mia_recall']:.2%} | EM={stats['exact_match']:.2%} | PPL={stats['avg_perplexity']:.2f} | CTX={stats['avg_contextual_score']:.4f}")
+                f"Epoch {epoch} (step {step}): MIA={stats['mia_recall']:.2%} | EM={stats['exact_match']:.2%} | PPL={stats['avg_perplexity']:.2f} | CTX={stats['avg_contextual_score']:.4f}")
 
             results.append(stats)
         else:
-            print(f"Epoch {epoch}: Insufficient data to analyze.")
+            print(f"Epoch {epoch} (step {step}): Insufficient data to analyze.")
 
     print("--- 5. SAVING RESULTS ---")
     # Save Summary
     summary_path = os.path.join(args.output_dir, "metrics_summary.csv")
     pd.DataFrame(results).to_csv(summary_path, index=False)
 
+    roc_path = os.path.join(args.output_dir, "roc_summary.csv")
+    df_roc.to_csv(roc_path, index=False)
+
     # Save Details
     details_path = os.path.join(args.output_dir, "canary_details_full.csv")
     df_processed.to_csv(details_path, index=False)
@@ -0,0 +1,101 @@
+import numpy as np
+
+DEFAULT_FPRS = (0.1, 0.01, 0.001)
+
+
+def allowed_false_positives(fpr, num_nonmembers):
+    """
+    Largest number of flagged non-members that keeps the false positive rate <= fpr.
+    """
+    return np.floor(np.asarray(fpr) * num_nonmembers + 1e-9).astype(np.int64)
+
+
+def threshold_at_fpr(nonmember_scores, fpr=0.1):
+    """
+    Decision threshold calibrated on non-member scores only: a sample is flagged as member when
+    its score is strictly above it. This is the (k+1)-th largest non-member score, with k the
+    allowed false positives; -inf when every non-member may be flagged.
+    """
+    scores = np.sort(np.asarray(nonmember_scores, dtype=np.float64))[::-1]
+    k = int(allowed_false_positives(fpr, len(scores)))
+    return scores[k] if k < len(scores) else -np.inf
+
+
+def _grouped_roc(scores, is_member, groups):
+    scores = np.asarray(scores, dtype=np.float64)
+    is_member = np.asarray(is_member, dtype=bool)
+    if groups is None:
+        keys, codes = np.zeros(1, dtype=np.int64), np.zeros(len(scores), dtype=np.int64)
+    else:
+        keys, codes = np.unique(np.asarray(groups), return_inverse=True)
+    num_groups = len(keys)
+
+    order = np.lexsort((-scores, codes))
+    s, m, g = scores[order], is_member[order], codes[order]
+    tp, fp = np.cumsum(m), np.cumsum(~m)
+    starts = np.searchsorted(g, np.arange(num_groups))
+    tp = tp - np.concatenate([[0], tp])[starts][g]
+    fp = fp - np.concatenate([[0], fp])[starts][g]
+
+    # Tied scores form a single point: keep the last sample of every (group, score) run
+    last = np.ones(len(s), dtype=bool)
+    last[:-1] = (g[1:] != g[:-1]) | (s[1:] != s[:-1])
+
+    positives = np.bincount(codes, weights=is_member, minlength=num_groups).astype(np.int64)
+    negatives = np.bincount(codes, minlength=num_groups) - positives
+    return keys, g[last], s[last], tp[last], fp[last], positives, negatives
+
+
+def roc_curves(scores, is_member, groups=None):
+    """
+    ROC curves of any number of groups (epochs, strata, score types...) with one sort.
+    Higher scores mean "member". Returns (keys, point_group, fpr, tpr, point_scores): the curve
+    of group keys[i] is the points with point_group == i, by decreasing score; each point
+    flags every sample of its group with score >= point_scores.
+    """
+    keys, g, s, tp, fp, positives, negatives = _grouped_roc(scores, is_member, groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return keys, g, fp / negatives[g], tp / positives[g], s
+
+
+def roc_metrics(scores, is_member, groups=None, fprs=DEFAULT_FPRS):
+    """
+    AUC, TPR at every FPR in fprs and the matching thresholds, for every group in one pass.
+    Returns a dict of arrays indexed like 'group' (tpr / threshold are [groups, len(fprs)]);
+    thresholds follow threshold_at_fpr, i.e. members are the samples with score > threshold.
+    Groups without members or without non-members get NaN.
+    """
+    fprs = np.asarray(fprs, dtype=np.float64)
+    keys, g, s, tp, fp, positives, negatives = _grouped_roc(scores, is_member, groups)
+    num_groups = len(keys)
+    valid = (positives > 0) & (negatives > 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tpr, fpr = tp / positives[g], fp / negatives[g]
+
+    # Trapezoidal AUC, every curve starting from (0, 0)
+    first = np.ones(len(g), dtype=bool)
+    first[1:] = g[1:] != g[:-1]
+    prev_fpr = np.where(first, 0.0, np.roll(fpr, 1))
+    prev_tpr = np.where(first, 0.0, np.roll(tpr, 1))
+    auc = np.bincount(g, weights=(fpr - prev_fpr) * (tpr + prev_tpr) / 2, minlength=num_groups)
+
+    # The points within the FPR budget are a prefix of each curve (fp grows with the index)
+    starts = np.searchsorted(g, np.arange(num_groups))
+    ends = np.append(starts[1:], len(g))
+    allowed = allowed_false_positives(fprs[None, :], negatives[:, None])
+    within = np.stack([
+        np.bincount(g, weights=fp <= allowed[g, j], minlength=num_groups) for j in range(len(fprs))
+    ], axis=1).astype(np.int64)
+    last_point = max(len(g) - 1, 0)
+    tpr_at = np.where(within > 0, tpr[np.clip(starts[:, None] + within - 1, 0, last_point)], 0.0)
+    cut = starts[:, None] + within
+    threshold = np.where(cut < ends[:, None], s[np.clip(cut, 0, last_point)], -np.inf)
+
+    return {
+        "group": keys,
+        "auc": np.where(valid, auc, np.nan),
+        "tpr": np.where(valid[:, None], tpr_at, np.nan),
+        "threshold": np.where(valid[:, None], threshold, np.nan),
+        "n_members": positives,
+        "n_nonmembers": negatives,
+    }
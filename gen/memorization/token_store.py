@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+LOGPROBS_FILE = "token_logprobs.f32"
+RANKS_FILE = "token_ranks.i32"
+INDEX_FILE = "token_index.csv"
+INDEX_COLUMNS = ["epoch", "step", "canary_id", "split", "offset", "length", "start", "prefix_len"]
+
+
+class TokenStoreWriter:
+    """
+    Append-only store of per-token target log-probs (float32) and target ranks (int32) of
+    the canaries at every evaluation point.
+
+    Both arrays are flat binary files; every appended canary gets one row in token_index.csv
+    with its offset and length in those files, the position of its first target token
+    (start) and its prefix length, so suffix tokens are the ones with position >= prefix_len.
+    """
+
+    def __init__(self, directory, overwrite=True):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.logprobs_path = os.path.join(directory, LOGPROBS_FILE)
+        self.ranks_path = os.path.join(directory, RANKS_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        if overwrite or not os.path.exists(self.index_path):
+            open(self.logprobs_path, "wb").close()
+            open(self.ranks_path, "wb").close()
+            with open(self.index_path, mode="w", encoding="utf-8") as f:
+                f.write(",".join(INDEX_COLUMNS) + "\n")
+        self.size = os.path.getsize(self.logprobs_path) // np.dtype(np.float32).itemsize
+
+    def append(self, epoch, step, canary_ids, splits, prefix_lens, starts, token_logprobs, token_ranks):
+        """
+        Appends one evaluation point (epoch, optimizer step); the other arguments are
+        per-canary sequences.
+        """
+        lengths = [len(lp) for lp in token_logprobs]
+        offsets = self.size + np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        with open(self.logprobs_path, "ab") as f:
+            for lp in token_logprobs:
+                np.asarray(lp, dtype=np.float32).tofile(f)
+        with open(self.ranks_path, "ab") as f:
+            for rk in token_ranks:
+                np.asarray(rk, dtype=np.int32).tofile(f)
+        # The index is written last, so every indexed row is backed by data on disk
+        with open(self.index_path, mode="a", encoding="utf-8") as f:
+            for cid, split, offset, length, start, prefix_len in zip(
+                    canary_ids, splits, offsets, lengths, starts, prefix_lens
+            ):
+                f.write(f"{epoch},{step},{cid},{split},{offset},{length},{start},{prefix_len}\n")
+        self.size += sum(lengths)
+
+
+class TokenStore:
+    """
+    Read-only view of a TokenStoreWriter directory. The arrays are memory-mapped, so selecting
+    a few epochs or canaries only touches the corresponding pages.
+    """
+
+    def __init__(self, directory):
+        self.index = pd.read_csv(os.path.join(directory, INDEX_FILE), dtype={"canary_id": str, "split": str})
+        self.logprobs = self._memmap(os.path.join(directory, LOGPROBS_FILE), np.float32)
+        self.ranks = self._memmap(os.path.join(directory, RANKS_FILE), np.int32)
+
+    @staticmethod
+    def _memmap(path, dtype):
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def select(self, epoch=None, canary_id=None, split=None, step=None):
+        """
+        Index rows matching the given epoch(s), canary id(s), split(s) and step(s); None means all.
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        for column, value in (("epoch", epoch), ("canary_id", canary_id), ("split", split), ("step", step)):
+            if value is not None:
+                values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+                mask &= self.index[column].isin(values).to_numpy()
+        return self.index[mask]
+
+    def tokens(self, row, suffix_only=False):
+        """
+        (log-probs, ranks) of one index row; with suffix_only only the suffix targets.
+        """
+        skip = max(row.prefix_len - row.start, 0) if suffix_only else 0
+        begin, end = row.offset + min(skip, row.length), row.offset + row.length
+        return self.logprobs[begin:end], self.ranks[begin:end]
+
+    def iter_tokens(self, rows, suffix_only=False):
+        """
+        Yields (index row, log-probs, ranks) for every row of a selection.
+        """
+        for row in rows.itertuples(index=False):
+            logprobs, ranks = self.tokens(row, suffix_only=suffix_only)
+            yield row, logprobs, ranks
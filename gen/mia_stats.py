@@ -0,0 +1,50 @@
+import math
+
+import numpy as np
+import torch
+
+
+def stratified_sample(num_examples, sample_size, seed=0):
+    """
+    Sorted indices of a seeded stratified sample of sample_size examples: the dataset order is
+    cut into sample_size contiguous strata of (almost) equal size and one example is drawn from
+    each, so the sample covers the whole corpus. All examples when sample_size >= num_examples.
+    """
+    if sample_size is None or sample_size >= num_examples:
+        return np.arange(num_examples)
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(0, num_examples, sample_size + 1).astype(np.int64)
+    lo, hi = edges[:-1], edges[1:]
+    return lo + (rng.random(sample_size) * (hi - lo)).astype(np.int64)
+
+
+def wilson_interval(successes, total, z=1.96):
+    """
+    Wilson score interval of a binomial proportion.
+    """
+    if total == 0:
+        return float("nan"), float("nan")
+    p = successes / total
+    denom = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def perplexity_interval(losses, z=1.96):
+    """
+    Normal-approximation interval of the mean per-example loss, mapped to perplexity.
+    """
+    losses = torch.as_tensor(losses, dtype=torch.float64)
+    if len(losses) < 2:
+        return float("nan"), float("nan")
+    mean = losses.mean().item()
+    half = z * losses.std().item() / math.sqrt(len(losses))
+    return _exp(mean - half), _exp(mean + half)
+
+
+def _exp(x):
+    try:
+        return math.exp(x)
+    except OverflowError:
+        return float("inf")
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def block_plan(doc_lengths, block_size, group_size=1000):
+    """
+    Blocks of the concatenated token stream of a split, as (starts, lengths) in stream positions.
+
+    Documents are concatenated group_size at a time (like a batched map of group_texts) and
+    every group is cut into block_size blocks, its remainder being dropped; a group shorter
+    than block_size is kept as one short block. group_size=None packs the whole split as one
+    group, i.e. the remainder is carried across groups and only the last one is dropped.
+    """
+    doc_lengths = np.asarray(doc_lengths, dtype=np.int64)
+    doc_starts = np.concatenate([[0], np.cumsum(doc_lengths)])
+    if group_size is None or len(doc_lengths) == 0:
+        group_starts, group_lengths = np.zeros(1, dtype=np.int64), doc_starts[-1:]
+    else:
+        first_docs = np.arange(0, len(doc_lengths), group_size)
+        group_starts = doc_starts[first_docs]
+        group_lengths = np.add.reduceat(doc_lengths, first_docs)
+
+    kept = np.where(group_lengths >= block_size, group_lengths // block_size * block_size, group_lengths)
+    counts = -(-kept // block_size)
+    group = np.repeat(np.arange(len(kept)), counts)
+    j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = group_starts[group] + j * block_size
+    lengths = np.minimum(block_size, kept[group] - j * block_size)
+    return starts, lengths
+
+
+def copy_blocks(chunks, starts, lengths, out):
+    """
+    Writes the planned blocks of a token stream, given as consecutive 1-D chunks, back to back
+    into out (e.g. a memory-mapped array), holding one chunk in memory at a time.
+    Returns the number of tokens written.
+    """
+    ends = starts + lengths
+    position = written = 0
+    for chunk in chunks:
+        lo, hi = position, position + len(chunk)
+        first, last = np.searchsorted(ends, lo, side="right"), np.searchsorted(starts, hi, side="left")
+        begin = np.clip(starts[first:last], lo, hi) - lo
+        end = np.clip(ends[first:last], lo, hi) - lo
+        # Blocks never overlap: +1 at every block start, -1 at every end marks the kept tokens
+        marks = np.bincount(begin, minlength=len(chunk) + 1) - np.bincount(end, minlength=len(chunk) + 1)
+        kept = chunk[np.cumsum(marks[:-1]) > 0]
+        out[written:written + len(kept)] = kept
+        written += len(kept)
+        position = hi
+    return written
+
+
+def document_offsets(doc_lengths, starts, lengths):
+    """
+    Positions, in the packed output, where the (non-empty, kept) documents begin.
+    """
+    doc_lengths = np.asarray(doc_lengths, dtype=np.int64)
+    doc_starts = (np.cumsum(doc_lengths) - doc_lengths)[doc_lengths > 0]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    block = np.searchsorted(starts, doc_starts, side="right") - 1
+    inside = (block >= 0) & (doc_starts < starts[np.maximum(block, 0)] + lengths[np.maximum(block, 0)])
+    out_starts = np.cumsum(lengths) - lengths
+    block = block[inside]
+    return out_starts[block] + doc_starts[inside] - starts[block]
@@ -0,0 +1,54 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from memorization.canary_set import tokenizer_fingerprint
+
+CACHE_VERSION = 1
+
+
+class RefLossCache:
+    """
+    Per-example losses of the reference model on the train and validation blocks, computed once
+    and stored as float32 .npy files that are memory-mapped on load.
+
+    Every split has its own file, keyed by the reference model name, the tokenizer fingerprint
+    and the fingerprint of the (tokenized and grouped) dataset, so a run on the same blocks reuses
+    it and any change in the data or tokenization gets a fresh one. Losses are in dataset order.
+    """
+
+    def __init__(self, cache_dir, ref_name, tokenizer, splits):
+        self.cache_dir = cache_dir
+        tok = tokenizer_fingerprint(tokenizer)
+        self.paths = {}
+        for split, dataset in splits.items():
+            fingerprint = getattr(dataset, "fingerprint", None) or dataset._fingerprint
+            key = f"{ref_name}|{tok}|{fingerprint}|{len(dataset)}|{CACHE_VERSION}"
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+            self.paths[split] = os.path.join(cache_dir, f"ref_losses_{split}_{digest}.npy")
+        self.losses = {}
+
+    def missing(self):
+        return [split for split, path in self.paths.items() if not os.path.exists(path)]
+
+    def save(self, split, losses):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.paths[split]
+        # Write then rename, so that concurrent runs never read a partial file.
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, np.asarray(losses, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+    def load(self):
+        self.losses = {split: np.load(path, mmap_mode="r") for split, path in self.paths.items()}
+        return self
+
+    def get(self, split, indices=None, device=None):
+        """
+        Reference losses of a split (of the given example indices only, if any) as a tensor.
+        """
+        losses = self.losses[split]
+        losses = losses[np.asarray(indices)] if indices is not None else np.asarray(losses)
+        return torch.from_numpy(np.array(losses, dtype=np.float32)).to(device)
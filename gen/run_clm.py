@@ -35,7 +35,25 @@ from pathlib import Path
 import copy 
 from sys import path
 import sys
+import time
 from utils import Logger
+from lm_head import causal_lm_loss, get_decoder_layers, get_lm_head, sequence_losses, untie_lm_head
+from async_eval import AsyncEvaluator
+from eval_schedule import AdaptiveEvalScheduler
+from early_stop import EarlyStopper, load_stop_epoch
+from mia_stats import perplexity_interval, stratified_sample, wilson_interval
+from exposure import ExposureEngine, SecretSpace
+from ref_cache import RefLossCache
+from canary_injection import InjectedDataset, canary_table
+from corpus_cache import CorpusCache
+from block_loader import block_dataloader
+from streaming import StreamingBlocks
+from activation_cache import ActivationCache
+from contextlib import nullcontext
+from canary_scoring import score_canaries, score_canaries_shared_prefix
+from memorization.canary_set import CanarySet
+from memorization.roc import DEFAULT_FPRS, roc_metrics, threshold_at_fpr
+from memorization.token_store import TokenStoreWriter
 from transformers import Adafactor
 from peft import LoraConfig, get_peft_model, TaskType
 import datasets
@@ -46,6 +64,7 @@ from tqdm.auto import tqdm
 
 import transformers
 from accelerate import Accelerator, DistributedType
+from accelerate.utils import broadcast_object_list, gather_object
 #from huggingface_hub import Repository
 from transformers import (
 #    CONFIG_MAPPING,
@@ -68,14 +87,16 @@ import numpy as np
 import random
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
 import csv
-from scipy.stats import skewnorm
-from scipy.stats import kstest
+import string
 
 
 transformers.logging.set_verbosity_error()
 
 logger = logging.getLogger(__name__)
 
+# Text before the digit secret of the legacy --add_canary canary
+DIGIT_CANARY_PREFIX = "the secret number is"
+
 require_version("datasets>=1.8.0", "To fix: pip install -r examples/pytorch/language-modeling/requirements.txt")
 
 #MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
@@ -143,7 +164,19 @@ def parse_args():
     parser.add_argument(
         "--do_ref_model",
         action="store_true",
-        help="If passed, will use a slow tokenizer (not backed by the 🤗 Tokenizers library).",
+        help="If passed, also run the reference-calibrated attack (loss minus reference-model loss).",
+    )
+    parser.add_argument(
+        "--ref_model_name_or_path",
+        type=str,
+        default=None,
+        help="Reference model of --do_ref_model (default: the pretrained model that is fine-tuned).",
+    )
+    parser.add_argument(
+        "--ref_cache_dir",
+        type=str,
+        default=None,
+        help="Where reference losses are cached (default: .ref_cache inside output_dir).",
     )
     parser.add_argument(
         "--add_adapter",
@@ -168,6 +201,28 @@ def parse_args():
         default=2,
         help="Batch size (per device) for the evaluation dataloader.",
     )
+    parser.add_argument(
+        "--per_device_mia_batch_size",
+        type=int,
+        default=None,
+        help="Batch size (per device) of the per-example validation / MIA loss passes (default: eval batch size).",
+    )
+    parser.add_argument(
+        "--mia_sample_size",
+        type=int,
+        default=None,
+        help=(
+            "Run the per-epoch validation / MIA passes on a fixed, seeded, stratified sample of this many blocks per "
+            "split (the same every epoch) instead of the whole splits. The end-of-training pass always uses everything."
+        ),
+    )
+    parser.add_argument(
+        "--mia_fprs",
+        type=float,
+        nargs="+",
+        default=list(DEFAULT_FPRS),
+        help="False positive rates at which the TPR of the loss-threshold attack is reported.",
+    )
     parser.add_argument(
         "--learning_rate",
         type=float,
@@ -191,8 +246,25 @@ def parse_args():
     parser.add_argument(
         "--eval_steps",
         type=int,
-        default=50,
-        help="Number of updates steps to accumulate before performing a backward/update pass.",
+        default=None,
+        help="If set, also evaluate the canaries every this many optimizer steps inside each epoch.",
+    )
+    parser.add_argument(
+        "--adaptive_eval",
+        action="store_true",
+        help="With --eval_steps, shorten the interval when canary metrics change fast and lengthen it on plateaus.",
+    )
+    parser.add_argument(
+        "--eval_budget",
+        type=float,
+        default=None,
+        help="With --eval_steps, cap the time of in-epoch canary evaluations to this fraction of training time.",
+    )
+    parser.add_argument(
+        "--eval_change_tol",
+        type=float,
+        default=0.05,
+        help="Mean suffix-loss change (per --eval_steps steps) above which --adaptive_eval evaluates more often.",
     )
     parser.add_argument(
         "--lr_scheduler_type",
@@ -225,9 +297,63 @@ def parse_args():
         default=None,
         help="The number of processes to use for the preprocessing.",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the train split instead of loading it: blocks are tokenized and packed on the fly "
+        "(the validation split is still loaded and cached).",
+    )
+    parser.add_argument(
+        "--stream_blocks_per_epoch",
+        type=int,
+        default=None,
+        help="With --streaming, the number of corpus blocks of one epoch-equivalent.",
+    )
+    parser.add_argument(
+        "--stream_shuffle_buffer",
+        type=int,
+        default=1000,
+        help="With --streaming, the number of blocks of the shuffle buffer.",
+    )
+    parser.add_argument(
+        "--canary_stream_rate",
+        type=float,
+        default=None,
+        help="With --streaming, the fraction of the blocks of every epoch that are canaries "
+        "(default: each train canary exactly its number of repetitions per epoch).",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Worker processes prefetching the batches of every dataloader (0: load in the main process).",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Batches prefetched by each dataloader worker.",
+    )
     parser.add_argument(
         "--overwrite_cache", type=bool, default=False, help="Overwrite the cached training and evaluation sets"
     )
+    parser.add_argument(
+        "--corpus_cache_dir",
+        type=str,
+        default=None,
+        help="Where the tokenized and packed base corpus is cached (default: packed_corpus in the datasets cache).",
+    )
+    parser.add_argument(
+        "--pack_carry_remainder",
+        action="store_true",
+        help="Pack each split as one token stream, carrying the remainder across groups of 1,000 texts "
+        "instead of dropping it (only the last partial block is dropped).",
+    )
+    parser.add_argument(
+        "--pack_doc_offsets",
+        action="store_true",
+        help="Also cache the offsets where documents begin in the packed token stream.",
+    )
     parser.add_argument(
         "--no_keep_linebreaks", action="store_true", help="Do not keep line breaks when using TXT files."
     )
@@ -239,8 +365,27 @@ def parse_args():
     parser.add_argument("--add_canary", action="store_true", help = "If true, then add canaries in the dataset.")
     parser.add_argument("--canary_rep", default=None, type = int, help = "The repetition of each canary")
     parser.add_argument("--canary_len", default = 5, type = int, help = "The len of digit of canaries")
+    parser.add_argument("--exposure_samples", default=5000, type=int,
+                        help="Candidate secrets sampled for exposure when the secret space is too large to enumerate.")
+    parser.add_argument("--exposure_max_exact", default=100000, type=int,
+                        help="Secret spaces up to this size are enumerated for an exact exposure.")
+    parser.add_argument("--canary_exposure", action="store_true",
+                        help="Log the exposure of the high_entropy train canaries of --canaries_csv every epoch.")
+    parser.add_argument("--exposure_alphabet", default=None, type=str,
+                        help="Alphabet the high_entropy secrets were drawn from, for --canary_exposure: "
+                             "letters_digits (generate_canaries.py, generate_multi_condition_canaries.py), "
+                             "lowercase_digits (generate_easy_canaries.py), digits, or the characters themselves. "
+                             "By default it is inferred from each secret.")
     parser.add_argument("--train_head_only",action="store_true", help = "If true, freeze all the layers except the head of the model.")
     parser.add_argument("--train_layer_n_only",default=None, type=int,  help = "If true, freeze all the layers except the n'th layer of the model.")
+    parser.add_argument("--activation_cache", action="store_true",
+                        help="With --train_head_only / --train_layer_n_only, compute the hidden states of the frozen "
+                             "layers once per block and only run the trainable tail afterwards. A head tied to the "
+                             "input embeddings (GPT-2) gets its own copy of the weights.")
+    parser.add_argument("--activation_cache_dir", type=str, default=None,
+                        help="Where cached activations are stored (default: <output_dir>/.activation_cache).")
+    parser.add_argument("--activation_cache_dtype", type=str, default="float32", choices=["float32", "float16"],
+                        help="Storage type of the cached activations.")
     #todo nuova da controllare
     parser.add_argument(
         "--canaries_csv",
@@ -253,12 +398,104 @@ def parse_args():
         action="store_true",
         help="If true, injects the canaries from --canaries_csv into the training set (D ∪ S).",
     )
+    parser.add_argument(
+        "--canary_eval_batch_size",
+        type=int,
+        default=16,
+        help="Number of canaries scored together (grouped by tokenized length) in compute_canary_losses.",
+    )
+    parser.add_argument(
+        "--canary_topk",
+        type=int,
+        default=0,
+        help="If > 0, log the top-k next tokens after each canary prefix to canary_topk.csv.",
+    )
+    parser.add_argument(
+        "--canary_match_mode",
+        type=str,
+        default="generate",
+        choices=["generate", "teacher_forced"],
+        help="How exact match is computed: greedy model.generate per canary, or argmax of the scoring pass.",
+    )
+    parser.add_argument(
+        "--canary_prefix_cache",
+        action="store_true",
+        help="Compute the KV cache of each distinct canary prefix once and fork it across the canaries sharing it.",
+    )
+    parser.add_argument(
+        "--canary_suffix_only",
+        action="store_true",
+        help="Apply the LM head only at suffix positions when scoring canaries (global_loss is logged as nan).",
+    )
+    parser.add_argument(
+        "--loss_chunk_size",
+        type=int,
+        default=None,
+        help="If set, compute the LM loss (training, canary, perplexity and MIA passes) over chunks of this many "
+             "positions without materializing the full [batch, seq, vocab] logits.",
+    )
+    parser.add_argument(
+        "--canary_cache_dir",
+        type=str,
+        default=None,
+        help="Where tokenized canaries are cached (default: .canary_cache next to --canaries_csv).",
+    )
+    parser.add_argument(
+        "--canary_token_store",
+        action="store_true",
+        help="Also store the per-token target log-probs and ranks of every canary at every evaluation "
+             "in a memory-mapped store (canary_tokens/, see memorization/token_store.py).",
+    )
+    parser.add_argument(
+        "--canary_train_telemetry",
+        action="store_true",
+        help="Tag the tokens of injected canaries and log their per-token training losses, taken from the "
+             "training forward pass, to canary_train_tokens.csv.",
+    )
+    parser.add_argument(
+        "--early_stop_em_patience",
+        type=int,
+        default=None,
+        help="Stop once the exactly extracted train-split canaries have not changed for this many canary "
+             "evaluations (counted from the first memorized canary).",
+    )
+    parser.add_argument(
+        "--early_stop_ppl_patience",
+        type=int,
+        default=None,
+        help="Stop once validation perplexity has risen for this many consecutive epochs.",
+    )
+    parser.add_argument(
+        "--stop_epoch_from",
+        type=str,
+        default=None,
+        help="early_stop.json of another run (e.g. M_C): stop after the same epoch, so both arms share the epoch grid.",
+    )
+    parser.add_argument(
+        "--async_canary_eval",
+        action="store_true",
+        help="Score the canaries on a snapshot of the trainable weights in a background thread while training "
+             "goes on (main process only; results are logged once collected, at the next evaluation or at the end). "
+             "Only canary scoring is moved: the validation perplexity, MIA and exposure passes still block training.",
+    )
 
     ###################################
 
     args = parser.parse_args()
 
     # Sanity checks
+    if args.early_stop_em_patience is not None and (args.canaries_csv is None or args.async_canary_eval):
+        raise ValueError("--early_stop_em_patience needs --canaries_csv and synchronous canary evaluation.")
+    if args.do_ref_model and args.ref_model_name_or_path is None and args.model_name_or_path is None:
+        raise ValueError("--do_ref_model needs a pretrained model or --ref_model_name_or_path.")
+    if args.activation_cache and not (args.train_head_only or args.train_layer_n_only is not None):
+        raise ValueError("--activation_cache needs --train_head_only or --train_layer_n_only.")
+    if args.activation_cache and (args.streaming or args.add_adapter):
+        raise ValueError("--activation_cache cannot be used with --streaming or --add_adapter.")
+    if args.streaming and args.stream_blocks_per_epoch is None:
+        raise ValueError("--streaming needs --stream_blocks_per_epoch.")
+    if args.canary_stream_rate is not None and not (args.streaming and 0 <= args.canary_stream_rate < 1):
+        raise ValueError("--canary_stream_rate needs --streaming and a rate in [0, 1).")
     if args.dataset_name is None and args.train_file is None and args.validation_file is None:
         raise ValueError("Need either a dataset name or a training/validation file.")
     else:
@@ -272,39 +509,10 @@ def parse_args():
  
     return args
 
-def get_exposure(fitting, main):
-
-    fitting_params = skewnorm.fit(fitting)
-    ks = kstest(fitting, 'skewnorm', fitting_params)
-
-    cdf = skewnorm.cdf(main, fitting_params[0], fitting_params[1], fitting_params[2])
-
-    
-    if cdf == 0.0:
-        exposure = 0.0
-    else:
-        exposure = -1.0*np.log2(cdf)
-    
-    
-    return exposure
-
-def get_fit_canary_loss(model,fitting_id, main_id):
-    loss_list = []
-    for k, v in main_id.items():
-            main_id[k] = torch.tensor(v).cuda()
-                  
-    loss_main = np.exp(model(**main_id)['loss'].item())
-
-    for sample in fitting_id:
-        for k, v in sample.items():
-            sample[k] = torch.tensor(v).cuda()
-        
-        output = model(**sample)
-        loss_list.append(np.exp(output.loss.item()))
-
-    return loss_main,loss_list
-
 def gen_canary(canary_len,tokenizer):
+        """
+        Random digit secret "d d ... d" of canary_len digits; returns (canary text, secret).
+        """
         raw_sample = random.choices([str(i) for i in range(10)], k=canary_len)
         raw_sample = " ".join(raw_sample)
         
@@ -312,10 +520,7 @@ def gen_canary(canary_len,tokenizer):
         ids = tokenizer.convert_tokens_to_ids(tokenized)
         assert len(ids) == canary_len
         
-        raw_sample = "the secret number is " + raw_sample
-        toked =  tokenizer(raw_sample)
-        toked['labels'] = toked['input_ids'].copy()
-        return raw_sample, toked
+        return f"{DIGIT_CANARY_PREFIX} {raw_sample}", raw_sample
 
 #TODO nuova da controllare
 def clean_text_to_latin(text):
@@ -330,81 +535,89 @@ def clean_text_to_latin(text):
     return text.encode("ascii", "ignore").decode("ascii")
 
 
-def compute_canary_losses(model, tokenizer, canary_prefixes, canary_suffixes, max_length=512):
-    global_losses = []
-    suffix_losses = []
+def compute_canary_losses(model, tokenizer, canaries, batch_size=16, top_k=0, match_mode="generate",
+                          prefix_cache=False, suffix_only=False, chunk_size=None):
+    """
+    Scores all canaries of a tokenized CanarySet and runs the greedy extraction check.
+    Returns a dict of per-canary lists: global_loss, suffix_loss, token_logprobs, token_ranks,
+    token_start, topk_tokens / topk_probs (empty unless top_k > 0), match_prefix_len, match_fraction,
+    exact_match, generated_text and teacher_forced_argmax (the decoded argmax of the scoring pass
+    at every suffix position, given the true preceding tokens).
+
+    match_mode="teacher_forced" reads exact match off the scoring pass (argmax equals the
+    target at every suffix position) and leaves generated_text empty, nothing being generated;
+    match_mode="generate" runs model.generate per canary and compares the decoded strings.
+
+    With prefix_cache=True canaries sharing a prefix reuse one prefix KV cache for scoring,
+    and greedy generation runs once per distinct prefix.
+
+    With suffix_only=True the LM head is only applied at the positions predicting a suffix
+    token; global_loss is then NaN. chunk_size applies the LM head over chunks of positions.
+    """
     exact_matches = []
     generated_texts = []
 
     model.eval()
-    IGNORE_INDEX = -100
 
     if tokenizer.pad_token_id is None:
         tokenizer.pad_token_id = tokenizer.eos_token_id
 
+    token_ids = canaries.token_lists()
+    prefix_lens = canaries.prefix_lens.tolist()
+
     with torch.no_grad():
-        for raw_prefix, raw_suffix in zip(canary_prefixes, canary_suffixes):
-
-            # --- NORMALIZZAZIONE DEGLI SPAZI (Soluzione al problema dell'Exact Match) ---
-            # 1. Rimuoviamo ogni spazio bianco finale dal prefisso
-            prefix = raw_prefix.rstrip()
-            # 2. Assicuriamoci che il suffisso inizi con esattamente uno spazio
-            suffix = " " + raw_suffix.lstrip()
-            # 3. Creiamo il testo completo normalizzato
-            full_text = prefix + suffix
-
-            # --- 1. Calcolo Loss (Target) ---
-            # Usiamo add_special_tokens=True per includere il BOS (es. <|begin_of_text|>)
-            inputs = tokenizer(full_text, return_tensors="pt", truncation=True, max_length=max_length,
-                               add_special_tokens=True)
-            input_ids = inputs["input_ids"].to(model.device)
-            attention_mask = inputs["attention_mask"].to(model.device)
-
-            # Calcoliamo la lunghezza del prefisso in modo coerente
-            prefix_inputs = tokenizer(prefix, return_tensors="pt", add_special_tokens=True)
-            prefix_len = prefix_inputs["input_ids"].shape[1]
-
-            # Suffix Loss (Masking prefix): calcoliamo la loss solo sulla parte "suffix"
-            labels_suffix = input_ids.clone()
-            labels_suffix[:, :prefix_len] = IGNORE_INDEX
-
-            outputs_suffix = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels_suffix)
-            suffix_losses.append(outputs_suffix.loss.item())
-
-            outputs_global = model(input_ids=input_ids, attention_mask=attention_mask, labels=input_ids)
-            global_losses.append(outputs_global.loss.item())
-
-            # --- 2. Analisi Probabilità & Generazione ---
-            prefix_ids = prefix_inputs["input_ids"].to(model.device)
-            prefix_mask = prefix_inputs["attention_mask"].to(model.device)
-
-            # --- BLOCCO DEBUG PROBABILITÀ ---
-            logits = model(input_ids=prefix_ids).logits[:, -1, :]
-            probs = torch.softmax(logits, dim=-1)
-            top_probs, top_ids = torch.topk(probs, 5)
-
-            print(f"\n[DEBUG PROB] Prefisso: '{prefix}'")
-            print(f"Target atteso: '{suffix.strip()[:15]}...' ")
-            for i in range(5):
-                token_str = tokenizer.decode([top_ids[0][i]])
-                safe_token = token_str.replace('\n', '\\n')
-                print(f"   Top {i + 1}: '{safe_token}' | Prob: {top_probs[0][i]:.4f}")
-
-            # Calcoliamo quanti token generare basandoci sulla tokenizzazione del suffisso
-            suffix_ids_only = tokenizer(suffix, add_special_tokens=False)["input_ids"]
-            max_new = len(suffix_ids_only) + 2
-
-            gen_out = model.generate(
-                input_ids=prefix_ids,
-                attention_mask=prefix_mask,
-                max_new_tokens=max_new,
-                do_sample=False,  # Greedy Search: sceglie sempre il più probabile
-                pad_token_id=tokenizer.pad_token_id,
-                eos_token_id=tokenizer.eos_token_id
-            )
+        # --- 1. Loss, per-token log-probs and top-k from a single forward pass ---
+        scorer = score_canaries_shared_prefix if prefix_cache else score_canaries
+        results = scorer(
+            model, token_ids, prefix_lens, tokenizer.pad_token_id, batch_size=batch_size, top_k=top_k,
+            suffix_only=suffix_only, chunk_size=chunk_size,
+        )
+        results["topk_tokens"] = [[tokenizer.decode([t]) for t in ids] for ids in results.pop("topk_ids")]
+        results["teacher_forced_argmax"] = [
+            clean_text_to_latin(tokenizer.decode(ids, skip_special_tokens=True)).strip()
+            for ids in results.pop("greedy_suffix_ids")
+        ]
+
+        if match_mode == "teacher_forced":
+            results["exact_match"] = results["token_exact_match"]
+            results["generated_text"] = [""] * len(token_ids)
+            return results
+
+        # Greedy decoding only depends on the prefix: with prefix_cache, generate once per distinct
+        # prefix with the largest budget of its group and truncate for the shorter suffixes.
+        generation_budget = {}
+        generation_cache = {}
+        if prefix_cache:
+            for ids, prefix_len in zip(token_ids, prefix_lens):
+                key = tuple(ids[:prefix_len])
+                generation_budget[key] = max(generation_budget.get(key, 0), len(ids) - prefix_len + 2)
+
+        for ids, prefix_len, suffix in zip(token_ids, prefix_lens, canaries.suffixes):
+            key = tuple(ids[:prefix_len])
+
+            # --- 2. Generazione ---
+            prefix_ids = torch.tensor([ids[:prefix_len]], dtype=torch.long, device=model.device)
+            prefix_mask = torch.ones_like(prefix_ids)
+
+            # Calcoliamo quanti token generare basandoci sulla lunghezza del suffisso
+            max_new = len(ids) - prefix_len + 2
+
+            if key in generation_cache:
+                gen_out = generation_cache[key]
+            else:
+                gen_out = model.generate(
+                    input_ids=prefix_ids,
+                    attention_mask=prefix_mask,
+                    max_new_tokens=generation_budget.get(key, max_new),
+                    do_sample=False,  # Greedy Search: sceglie sempre il più probabile
+                    pad_token_id=tokenizer.pad_token_id,
+                    eos_token_id=tokenizer.eos_token_id
+                )
+                if prefix_cache:
+                    generation_cache[key] = gen_out
 
             # Estraiamo i token generati (tutto quello che viene dopo il prefisso)
-            gen_suffix_ids = gen_out[0][prefix_len:]
+            gen_suffix_ids = gen_out[0][prefix_len:prefix_len + max_new]
             raw_gen_text = tokenizer.decode(gen_suffix_ids, skip_special_tokens=True)
 
             # Pulizia per il confronto finale
@@ -418,7 +631,143 @@ def compute_canary_losses(model, tokenizer, canary_prefixes, canary_suffixes, ma
             else:
                 exact_matches.append(0)
 
-    return global_losses, suffix_losses, exact_matches, generated_texts
+    results["exact_match"] = exact_matches
+    results["generated_text"] = generated_texts
+    return results
+
+
+def compute_canary_losses_sharded(accelerator, model, tokenizer, canaries, **kwargs):
+    """
+    Splits the canaries across processes, scores each slice with compute_canary_losses and
+    gathers the per-canary results on every process, in the original canary order.
+    Canaries are sharded by sorted prefix so that shared prefixes stay on the same process.
+    """
+    n = len(canaries)
+    order = sorted(range(n), key=lambda i: canaries.prefixes[i])
+    rank, world = accelerator.process_index, accelerator.num_processes
+    shard = order[n * rank // world: n * (rank + 1) // world]
+
+    local = compute_canary_losses(
+        model=accelerator.unwrap_model(model),
+        tokenizer=tokenizer,
+        canaries=canaries.subset(shard),
+        **kwargs,
+    )
+    records = [(i, {k: v[j] for k, v in local.items()}) for j, i in enumerate(shard)]
+    if world > 1:
+        records = gather_object(records)
+    records.sort(key=lambda r: r[0])
+    return {k: [r[1][k] for r in records] for k in local}
+
+
+def compute_example_losses(accelerator, model, dataloader, chunk_size=None, activation_cache=None):
+    """
+    Per-example mean token loss of every example of a (non-shuffled) prepared dataloader,
+    gathered from all processes in dataset order; gather_for_metrics drops the samples
+    duplicated to even out the last batch across processes. With an activation_cache only
+    the trainable tail of the model is run.
+    """
+    model.eval()
+    losses = []
+    for batch in dataloader:
+        with torch.no_grad(), activation_cache.inject(model, batch) if activation_cache is not None else nullcontext():
+            losses.append(accelerator.gather_for_metrics(sequence_losses(model, batch, chunk_size)))
+    return torch.cat(losses)
+
+
+def loss_attack_roc(attacks, fprs):
+    """
+    ROC of the loss-threshold attacks in a single roc_metrics call. attacks maps a name to
+    (train values, validation values) of a per-example loss (or loss ratio): train examples are
+    the members, and a lower value means member. Returns name -> {"auc", "tpr" (one per fpr)}.
+    """
+    names = list(attacks)
+    scores = torch.cat([-torch.cat(attacks[name]) for name in names]).float().cpu().numpy()
+    is_member = np.concatenate([
+        np.arange(len(train) + len(val)) < len(train) for train, val in (attacks[name] for name in names)
+    ])
+    groups = np.repeat(np.arange(len(names)), [sum(len(v) for v in attacks[name]) for name in names])
+    roc = roc_metrics(scores, is_member, groups, fprs)
+    return {name: {"auc": roc["auc"][i], "tpr": roc["tpr"][i]} for i, name in enumerate(names)}
+
+
+def print_attack_roc(attack_roc, fprs):
+    for name, roc in attack_roc.items():
+        tprs = " ".join(f"TPR@{fpr:g}={tpr:.4f}" for fpr, tpr in zip(fprs, roc["tpr"]))
+        print(f"{name} attack: AUC={roc['auc']:.4f} {tprs}")
+
+
+def write_canary_results(epoch, step, canary_results, canary_ids, canary_suffixes, canary_splits, canary_log_path,
+                         generations_log_path, topk_log_path=None, token_store=None, prefix_lens=None):
+    """
+    Appends the canary results of one evaluation (at epoch, optimizer step) to canary_loss_log.csv and canary_generations.csv
+    (and canary_topk.csv if topk_log_path is given, the per-token store if token_store is
+    given), then prints the generation check.
+    """
+    exact_matches = canary_results["exact_match"]
+    generated_texts = canary_results["generated_text"]
+
+    with open(canary_log_path, mode="a", encoding="utf-8") as f:
+        for cid, g_loss, s_loss, em, split_val, m_len, m_frac in zip(
+                canary_ids, canary_results["global_loss"], canary_results["suffix_loss"], exact_matches,
+                canary_splits, canary_results["match_prefix_len"], canary_results["match_fraction"]
+        ):
+            f.write(f"{epoch},{step},{cid},{g_loss},{s_loss},{em},{split_val},{m_len},{m_frac}\n")
+
+    with open(generations_log_path, mode="a", encoding="utf-8") as f_gen:
+        for cid, target, gen, em, argmax in zip(
+                canary_ids, canary_suffixes, generated_texts, exact_matches, canary_results["teacher_forced_argmax"]
+        ):
+            safe_gen = gen.replace("\n", " ").replace(",", ";")
+            safe_target = target.replace("\n", " ").replace(",", ";")
+            safe_argmax = argmax.replace("\n", " ").replace(",", ";")
+            status = "MEMORIZED" if em == 1 else "MISSED"
+
+            f_gen.write(f"{epoch},{step},{cid},{safe_target},{safe_gen},{status},{safe_argmax}\n")
+
+    if topk_log_path is not None:
+        with open(topk_log_path, mode="a", encoding="utf-8") as f_top:
+            for cid, tokens, probs in zip(canary_ids, canary_results["topk_tokens"], canary_results["topk_probs"]):
+                for rank, (token, prob) in enumerate(zip(tokens, probs), start=1):
+                    safe_token = token.replace("\n", "\\n").replace(",", ";")
+                    f_top.write(f"{epoch},{step},{cid},{rank},{safe_token},{prob}\n")
+
+    if token_store is not None:
+        token_store.append(
+            epoch, step, canary_ids, canary_splits, prefix_lens, canary_results["token_start"],
+            canary_results["token_logprobs"], canary_results["token_ranks"],
+        )
+
+    print(f"\n[EPOCH {epoch} STEP {step} GENERATION CHECK]")
+    for cid, gen, em, split_val in zip(canary_ids, generated_texts, exact_matches, canary_splits):
+        color = "\033[92m" if em == 1 else "\033[91m"
+        reset = "\033[0m"
+        print(f"   -> {cid} ({split_val}): '{gen}' [{color}{'MEMORIZED' if em == 1 else 'MISSED'}{reset}]")
+    print("-" * 50)
+
+
+def write_canary_train_tokens(f, step, epoch, canaries, canary_tag, canary_pos, token_losses):
+    """
+    Appends one row per canary token seen as a training target: its position in the canary's
+    token ids, whether it is a suffix token, and its loss in the training forward pass.
+    """
+    for tag, pos, loss in zip(canary_tag.tolist(), canary_pos.tolist(), token_losses.tolist()):
+        suffix = int(pos >= canaries.prefix_lens[tag])
+        f.write(f"{step},{epoch},{canaries.ids[tag]},{pos},{suffix},{loss}\n")
+
+
+def write_canary_exposure(epoch, step, exposure_engines, model, accelerator, exposure_log_path):
+    """
+    Computes and appends the exposure of every canary with an exposure engine.
+    """
+    rows = [(cid, split, engine.exposure(model, accelerator)) for cid, split, engine in exposure_engines]
+    if accelerator.is_local_main_process:
+        with open(exposure_log_path, mode="a", encoding="utf-8") as f:
+            for cid, split, e in rows:
+                f.write(f"{epoch},{step},{cid},{split},{e['exposure']},{e['exposure_fit']},{e['rank']},"
+                        f"{e['log_perplexity']},{e['num_candidates']},{int(e['exact'])}\n")
+
+
 def main():
 
     args = parse_args()
@@ -438,49 +787,54 @@ def main():
 
     #TODO NUOVO DA CONTROLLARE
     # --- BLOCK 1: Load Canaries (Updated for Prefix/Suffix/Split) ---
-    eval_canary_ids = []
-    eval_canary_prefixes = []
-    eval_canary_suffixes = []
-    eval_canary_repetitions = []
-    eval_canary_splits = []
-
+    # Note: The CSV must have columns: canary_id, prefix, suffix (+ optional repetitions, split, type, complexity)
+    canaries = None
     if args.canaries_csv is not None:
-        import csv
-        # Note: The CSV must now have columns: canary_id, prefix, suffix, repetitions, split
-        with open(args.canaries_csv, mode="r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                eval_canary_ids.append(row["canary_id"])
-                eval_canary_prefixes.append(row["prefix"])
-                eval_canary_suffixes.append(row["suffix"])
-
-                # Leggiamo lo split. Se non c'è, assumiamo 'train' per retro-compatibilità
-                split_val = row.get("split", "train")
-                eval_canary_splits.append(split_val)  # <--- SALVIAMO LO SPLIT
-
-                rep_str = row.get("repetitions", "1")
-                try:
-                    rep_value = int(rep_str)
-                except ValueError:
-                    rep_value = 1
-                eval_canary_repetitions.append(max(rep_value, 0))
+        canaries = CanarySet.from_csv(args.canaries_csv)
     #######################################################à
     # Path for logging per-epoch canary losses
     # --- BLOCK 2: Log File Header (Updated) ---
     canary_log_path = os.path.join(directory, "canary_loss_log.csv")
     generations_log_path = os.path.join(directory, "canary_generations.csv")
     metrics_summary_path = os.path.join(directory, "metrics_summary.csv")
+    early_stop_path = os.path.join(directory, "early_stop.json")
+    mia_fprs = sorted(set(args.mia_fprs), reverse=True)
+    topk_log_path = os.path.join(directory, "canary_topk.csv")
+    exposure_log_path = os.path.join(directory, "canary_exposure.csv")
+    stream_positions_path = os.path.join(directory, "canary_stream_positions.csv")
+    token_store = None
 
     if accelerator.is_local_main_process:
         with open(generations_log_path, mode="w", encoding="utf-8") as f:
-            f.write("epoch,canary_id,target_suffix,generated_suffix,status\n")
+            f.write("epoch,step,canary_id,target_suffix,generated_suffix,status,teacher_forced_argmax\n")
         with open(metrics_summary_path, mode="w", encoding="utf-8") as f:
-            f.write("epoch,avg_perplexity\n")
+            f.write("epoch,step,avg_perplexity,perplexity_low,perplexity_high,mia_ratio,mia_ratio_low,mia_ratio_high,"
+                    "val_examples,train_examples,mia_auc," + ",".join(f"mia_tpr_at_{fpr:g}" for fpr in mia_fprs) + "\n")
+        if args.streaming:
+            with open(stream_positions_path, mode="w", encoding="utf-8") as f:
+                f.write("epoch,position,canary_id\n")
 
     if args.canaries_csv is not None and accelerator.is_local_main_process:
         with open(canary_log_path, mode="w", encoding="utf-8") as f:
             # Updated header to include exact_match
-            f.write("epoch,canary_id,global_loss,suffix_loss,exact_match,split\n")
+            f.write("epoch,step,canary_id,global_loss,suffix_loss,exact_match,split,match_prefix_len,match_fraction\n")
+        if args.canary_topk > 0:
+            with open(topk_log_path, mode="w", encoding="utf-8") as f:
+                f.write("epoch,step,canary_id,rank,token,prob\n")
+        if args.canary_token_store:
+            token_store = TokenStoreWriter(os.path.join(directory, "canary_tokens"))
+        if args.canary_exposure:
+            with open(exposure_log_path, mode="w", encoding="utf-8") as f:
+                f.write("epoch,step,canary_id,split,exposure,exposure_fit,rank,log_perplexity,num_candidates,exact\n")
+
+    # Every process logs the canary tokens of its own batches
+    telemetry_file = None
+    if args.canary_train_telemetry:
+        if not args.inject_canaries_in_training:
+            raise ValueError("--canary_train_telemetry needs --inject_canaries_in_training.")
+        rank_suffix = f"_rank{accelerator.process_index}" if accelerator.num_processes > 1 else ""
+        telemetry_file = open(os.path.join(directory, f"canary_train_tokens{rank_suffix}.csv"), mode="w", encoding="utf-8")
+        telemetry_file.write("step,epoch,canary_id,position,suffix,loss\n")
     # ------------------------------------------
     ####################################
     if accelerator.is_local_main_process:
@@ -530,7 +884,32 @@ def main():
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if args.dataset_name is not None:
+    if args.streaming:
+        # Only the train split is streamed; the validation split is needed in full by the MIA passes
+        data_files, dataset_args = {}, {}
+        if args.dataset_name is not None and 'enron' in args.dataset_name:
+            builder = 'csv'
+            data_files = {'train': 'data/cleaned_short_train_scrubbed.csv', 'validation': 'data/cleaned_short_test_scrubbed.csv'}
+        elif args.dataset_name is not None:
+            builder = args.dataset_name
+        else:
+            if args.validation_file is None:
+                raise ValueError("--streaming needs a --validation_file.")
+            builder = args.train_file.split(".")[-1]
+            if builder == "txt":
+                builder = "text"
+                dataset_args["keep_linebreaks"] = not args.no_keep_linebreaks
+            data_files = {"train": args.train_file, "validation": args.validation_file}
+        if not data_files:
+            dataset_args["name"] = args.dataset_config_name
+        # Each call only gets the files of its own split, so the train file is never converted to Arrow
+        train_stream = load_dataset(
+            builder, split="train", streaming=True, data_files=data_files and {"train": data_files["train"]}, **dataset_args
+        )
+        raw_datasets = datasets.DatasetDict(validation=load_dataset(
+            builder, split="validation", data_files=data_files and {"validation": data_files["validation"]}, **dataset_args
+        ))
+    elif args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         if 'enron' in args.dataset_name:
             raw_datasets =   load_dataset('csv', data_files={'train': 'data/cleaned_short_train_scrubbed.csv' ,'validation': 'data/cleaned_short_test_scrubbed.csv'})
@@ -581,70 +960,10 @@ def main():
                 **dataset_args,
             )
 
-    # TODO NUOVO
-    # -----------------------------------------
-    # Inject canaries into TRAINING set using per-canary repetitions from CSV
-    # (M_C = D ∪ S)
-    # -----------------------------------------
-    # --- BLOCK 3: Injection Logic (Updated) ---
-    if args.inject_canaries_in_training:
-        if args.canaries_csv is None:
-            raise ValueError("inject_canaries_in_training is True but no CSV provided.")
-
-        # ... (keep existing checks on dict_key) ...
-        if args.dataset_name is not None and 'enron' in args.dataset_name:
-            dict_key = 'sentence'
-        else:
-            dict_key = 'text'
-
-        new_canary_rows = []
-        total_injected = 0
-
-        # Iterate over prefix/suffix to reconstruct the full training text
-        # Iterate over prefix/suffix AND SPLIT to reconstruct the full training text
-        for canary_id, prefix, suffix, reps, split_val in zip(
-                eval_canary_ids,
-                eval_canary_prefixes,
-                eval_canary_suffixes,
-                eval_canary_repetitions,
-                eval_canary_splits
-        ):
-
-            if split_val == 'validation':
-                if accelerator.is_local_main_process:
-                    print(f"[Inject canaries] Skipping injection for Canary {canary_id} (Split: validation)")
-                continue
-
-            full_text = prefix + suffix  # Concatenate for training
-            reps_int = max(int(reps), 0)
-
-            if accelerator.is_local_main_process:
-                print(f"[Inject canaries] Canary {canary_id} injected {reps_int} times. (Split: train)")
-
-            for _ in range(reps_int):
-                new_canary_rows.append({dict_key: full_text})
-                total_injected += 1
-
-        # 2. Create a temporary dataset and concatenate once
-        if len(new_canary_rows) > 0:
-            canary_ds = datasets.Dataset.from_list(new_canary_rows)
-            canary_ds = canary_ds.cast(raw_datasets["train"].features)
-            raw_datasets["train"] = datasets.concatenate_datasets([raw_datasets["train"], canary_ds])
-
-        raw_datasets["train"] = raw_datasets["train"].shuffle(seed=args.seed)
-        # ------------------------------------------
-        # --- END MODIFICATION ---
-
-        if accelerator.is_local_main_process:
-            print(
-                f"[Inject canaries] After injection, train size = "
-                f"{len(raw_datasets['train'][dict_key])} "
-                f"(total injected examples = {total_injected})"
-            )
-    # -----------------------------------------
-    #
-
-
+    # Canaries are injected after packing, as extra blocks indexed over the unmodified corpus
+    # (see InjectedDataset below), so nothing is added to the raw datasets here
+    if args.inject_canaries_in_training and args.canaries_csv is None:
+        raise ValueError("inject_canaries_in_training is True but no CSV provided.")
 
     # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
     # https://huggingface.co/docs/datasets/loading_datasets.html.
@@ -671,6 +990,14 @@ def main():
             "You can do it from another script, save it, and load it from here, using --tokenizer_name."
         )
 
+    # Tokenize the canaries once for the whole run (cached across runs sharing the tokenizer)
+    if canaries is not None:
+        canary_cache_dir = args.canary_cache_dir or os.path.join(
+            os.path.dirname(os.path.abspath(args.canaries_csv)), ".canary_cache"
+        )
+        with accelerator.main_process_first():
+            canaries.tokenize(tokenizer, cache_dir=canary_cache_dir)
+
     if args.model_name_or_path:
         model = AutoModelForCausalLM.from_pretrained(
             args.model_name_or_path,
@@ -685,58 +1012,41 @@ def main():
 
     model.resize_token_embeddings(len(tokenizer))
     
-    # model_ref = copy.deepcopy(model)
-
 
     if args.add_canary:    
-        if 'ptb' in args.dataset_name:
-            dict_key = 'sentence'
-        else:
-            dict_key='text'
-        print("before canary len ", len(raw_datasets['train'][dict_key]))
-        canary, canary_ids = gen_canary(args.canary_len, tokenizer)
-        for j in range(args.canary_rep):
-            raw_datasets['train']=raw_datasets['train'].add_item({dict_key:canary})
-
-        raw_datasets['train'] = raw_datasets['train'].shuffle(seed=args.seed)
-        print("after canary len ", len(raw_datasets['train'][dict_key]))
+        # The canary_rep copies are injected as indexed canary blocks after packing
+        canary, canary_secret = gen_canary(args.canary_len, tokenizer)
         # save the canaries in csv
 
-        file = open(f'./{directory}/canaries.txt', 'w+')
+        file = open(os.path.join(directory, 'canaries.txt'), 'w+')
         file.write(canary)
         file.write('\n')
         file.close()
 
-        file = open(f'./{directory}/fitting_canaries.txt', 'w+')
-        
-        fitting_canaries_ids = []
-        for i in range(5000):
-            fit , fit_ids = gen_canary(args.canary_len,tokenizer)
-            if fit != canary:
-                fitting_canaries_ids.append(fit_ids)
-                file.write(fit)
-                file.write('\n')
-        print(len(fitting_canaries_ids))
+        # Candidates are every other digit secret when the space is small enough, a fixed sample otherwise
+        exposure_engine = ExposureEngine(
+            tokenizer, DIGIT_CANARY_PREFIX, canary_secret, SecretSpace(string.digits, args.canary_len, " "),
+            num_samples=args.exposure_samples, max_exact=args.exposure_max_exact, seed=args.seed or 0,
+            batch_size=args.canary_eval_batch_size,
+        )
+        file = open(os.path.join(directory, 'fitting_canaries.txt'), 'w+')
+        for fit in exposure_engine.secrets:
+            file.write(f"{DIGIT_CANARY_PREFIX} {fit}")
+            file.write('\n')
+        file.close()
+        print(len(exposure_engine.secrets))
             
 
 
     # Preprocessing the datasets.
     # First we tokenize all the texts.
-    column_names = raw_datasets["train"].column_names
+    column_names = raw_datasets["validation" if args.streaming else "train"].column_names
     text_column_name = "text" if "text" in column_names else column_names[0]
 
     def tokenize_function(examples):
-        return tokenizer([str(x) for x in examples[text_column_name]])
-
-    with accelerator.main_process_first():
-        tokenized_datasets = raw_datasets.map(
-            tokenize_function,
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on dataset",
-        )
+        # Only the token ids are kept: packed blocks have no padding, attention_mask is all ones
+        output = tokenizer([str(x) for x in examples[text_column_name]])
+        return {"input_ids": output["input_ids"]}
 
     if args.block_size is None:
         block_size = tokenizer.model_max_length
@@ -754,42 +1064,96 @@ def main():
             )
         block_size = min(args.block_size, tokenizer.model_max_length)
 
-    # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
-    def group_texts(examples):
-        # Concatenate all texts.
-        
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
-        # customize this part to your needs.
-        if total_length >= block_size:
-            total_length = (total_length // block_size) * block_size
-        # Split by chunks of max_len.
-        result = {
-            k: [t[i : i + block_size] for i in range(0, total_length, block_size)]
-            for k, t in concatenated_examples.items()
-        }
-        result["labels"] = result["input_ids"].copy()
-        return result
-
-    # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
-    # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
-    # to preprocess.
-    #
-    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
-    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
-
-    with accelerator.main_process_first():
-        lm_datasets = tokenized_datasets.map(
-            group_texts,
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            load_from_cache_file=not args.overwrite_cache,
-            desc=f"Grouping texts in chunks of {block_size}",
+    # Packing (see packing.py) concatenates the token ids of 1,000 texts at a time and cuts them into
+    # blocks of block_size, dropping the remainder of every group, like a batched map of group_texts;
+    # --pack_carry_remainder packs the whole split as one stream instead. It runs on the flat Arrow
+    # token buffers and writes the blocks straight into the memory-mapped corpus cache, which is
+    # kept per raw dataset / tokenizer / block size and shared by every run on it (both experiment
+    # arms included); only the missing splits are tokenized and packed.
+    corpus_cache = CorpusCache(
+        args.corpus_cache_dir or os.path.join(datasets.config.HF_DATASETS_CACHE, "packed_corpus"),
+        raw_datasets, tokenizer, block_size, text_column_name,
+        carry_remainder=args.pack_carry_remainder, doc_offsets=args.pack_doc_offsets,
+    )
+    rebuild = broadcast_object_list([list(raw_datasets) if args.overwrite_cache else corpus_cache.missing()])[0]
+    if rebuild:
+        logger.info(f"Tokenizing and packing the {', '.join(rebuild)} split(s) into {corpus_cache.cache_dir}")
+        with accelerator.main_process_first():
+            tokenized_datasets = datasets.DatasetDict({split: raw_datasets[split] for split in rebuild}).map(
+                tokenize_function,
+                batched=True,
+                num_proc=args.preprocessing_num_workers,
+                remove_columns=column_names,
+                load_from_cache_file=not args.overwrite_cache,
+                desc="Running tokenizer on dataset",
+            )
+
+        if accelerator.is_main_process:
+            for split in tokenized_datasets:
+                corpus_cache.pack(split, tokenized_datasets[split])
+        accelerator.wait_for_everyone()
+    else:
+        logger.info(f"Loading the packed corpus from {corpus_cache.cache_dir}")
+
+    train_dataset = None if args.streaming else corpus_cache.load("train")
+    eval_dataset = corpus_cache.load("validation")
+
+    # Canary injection (M_C = D ∪ S): one block per canary, repeated through the index of an
+    # InjectedDataset (or interleaved into the stream); train-split canaries of the CSV get their
+    # repetitions, the --add_canary digit canary gets canary_rep. With telemetry, every canary
+    # token is tagged with its canary.
+    inject_tokens, inject_reps, inject_tags, inject_names = [], [], [], []
+    if args.inject_canaries_in_training:
+        for canary_index, (canary_id, reps, split_val) in enumerate(zip(canaries.ids, canaries.repetitions, canaries.splits)):
+            if split_val == 'validation':
+                if accelerator.is_local_main_process:
+                    print(f"[Inject canaries] Skipping injection for Canary {canary_id} (Split: validation)")
+                continue
+            if accelerator.is_local_main_process:
+                print(f"[Inject canaries] Canary {canary_id} injected {int(reps)} times. (Split: train)")
+            inject_tokens.append(canaries.canary_tokens(canary_index).tolist())
+            inject_reps.append(int(reps))
+            inject_tags.append(canary_index)
+            inject_names.append(canary_id)
+    if args.add_canary:
+        inject_tokens.append(tokenizer(canary)["input_ids"])
+        inject_reps.append(args.canary_rep or 0)
+        inject_tags.append(-1)
+        inject_names.append("add_canary")
+    table, canary_index = None, None
+    if inject_tokens:
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        if max(len(ids) for ids in inject_tokens) > block_size:
+            logger.warning(f"Canaries longer than block_size={block_size} are truncated in training.")
+        table = canary_table(
+            inject_tokens, block_size, pad_token_id, tags=inject_tags if args.canary_train_telemetry else None
         )
+        canary_index = np.repeat(np.arange(len(inject_tokens)), inject_reps)
+    if inject_tokens and not args.streaming:
+        train_dataset = InjectedDataset(train_dataset, table, canary_index, tag_base=args.canary_train_telemetry)
+        if accelerator.is_local_main_process:
+            print(
+                f"[Inject canaries] After injection, train size = {len(train_dataset)} blocks "
+                f"(total injected canary blocks = {len(train_dataset.index)})"
+            )
 
-    train_dataset = lm_datasets["train"]
-    eval_dataset = lm_datasets["validation"]
+    # Streaming: the membership passes run on the first blocks of the stream (trained on in the
+    # first epoch), as many as --mia_sample_size or the validation blocks
+    mia_train_dataset = train_dataset
+    if args.streaming:
+        train_dataset = StreamingBlocks(
+            train_stream, text_column_name, tokenizer, block_size, args.stream_blocks_per_epoch,
+            table=table, index=canary_index, names=inject_names, canary_rate=args.canary_stream_rate,
+            shuffle_buffer=args.stream_shuffle_buffer, seed=args.seed or 0, tag_base=args.canary_train_telemetry,
+            carry_remainder=args.pack_carry_remainder,
+            position_log=stream_positions_path if accelerator.is_local_main_process else None,
+        )
+        mia_train_dataset = train_dataset.members(args.mia_sample_size or len(eval_dataset))
+        if accelerator.is_local_main_process:
+            print(
+                f"[Streaming] {args.stream_blocks_per_epoch} corpus blocks and {len(train_dataset.canary_rows)} "
+                f"canary blocks per epoch, {len(mia_train_dataset)} member blocks for the MIA passes"
+            )
     
     
     #for i in range(len(train_dataset)):
@@ -803,13 +1167,43 @@ def main():
     #for index in random.sample(range(len(train_dataset)), 3):
     #    logger.info(f"Sample {index} of the training set: {train_dataset[index]}.")
 
-    # DataLoaders creation:
-    train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=default_data_collator, batch_size=args.per_device_train_batch_size
-    )
-    eval_dataloader = DataLoader(
-        eval_dataset, collate_fn=default_data_collator, batch_size=args.per_device_eval_batch_size
-    )
+    # With --activation_cache the batches also carry the block indices, to look up the frozen states
+    activation_cache = None
+    if args.activation_cache:
+        activation_cache = ActivationCache(
+            args.activation_cache_dir or os.path.join(args.output_dir, ".activation_cache"), args.model_name_or_path,
+            {"train": train_dataset, "validation": eval_dataset},
+            layer=None if args.train_head_only else args.train_layer_n_only, dtype=args.activation_cache_dtype,
+        )
+        train_dataset = mia_train_dataset = activation_cache.indexed("train")
+        eval_dataset = activation_cache.indexed("validation")
+
+    # DataLoaders creation: every pass reads the memory-mapped blocks one whole batch at a time
+    loader_kwargs = {"num_workers": args.dataloader_num_workers, "prefetch_factor": args.dataloader_prefetch_factor}
+    if args.streaming:
+        # A single worker at most: the stream cannot be split across workers
+        train_dataloader = block_dataloader(
+            train_dataset, args.per_device_train_batch_size, num_workers=min(args.dataloader_num_workers, 1),
+            prefetch_factor=args.dataloader_prefetch_factor,
+        )
+    else:
+        train_dataloader = block_dataloader(
+            train_dataset, args.per_device_train_batch_size, shuffle=True, seed=args.seed, **loader_kwargs
+        )
+    # The validation / MIA passes score every example on its own, in dataset order (no shuffling)
+    mia_batch_size = args.per_device_mia_batch_size or args.per_device_eval_batch_size
+    eval_dataloader = block_dataloader(eval_dataset, mia_batch_size, **loader_kwargs)
+    mia_train_dataloader = block_dataloader(mia_train_dataset, mia_batch_size, **loader_kwargs)
+    # Per-epoch passes may run on a fixed stratified sample; the end-of-training pass uses every example
+    sample_seed = args.seed if args.seed is not None else 0
+    eval_sample, train_sample = None, None
+    if args.mia_sample_size is not None:
+        eval_sample = stratified_sample(len(eval_dataset), args.mia_sample_size, sample_seed)
+        train_sample = stratified_sample(len(mia_train_dataset), args.mia_sample_size, sample_seed)
+        epoch_eval_dataloader = block_dataloader(eval_dataset.select(eval_sample), mia_batch_size, **loader_kwargs)
+        epoch_mia_train_dataloader = block_dataloader(
+            mia_train_dataset.select(train_sample), mia_batch_size, **loader_kwargs
+        )
 
 
     if args.add_adapter:
@@ -834,14 +1228,9 @@ def main():
     if args.train_head_only:
         for params in model.parameters():
             params.requires_grad = False
-        if hasattr(model, "lm_head"):
-            # GPT-2, Llama, ecc.
-            head_layer = model.lm_head
-        elif hasattr(model, "embed_out"):
-            # Pythia / GPT-NeoX
-            head_layer = model.embed_out
-        else:
-            raise AttributeError("Could not find the model head (neither 'lm_head' nor 'embed_out').")
+        if args.activation_cache and untie_lm_head(model):
+            logger.warning("The head was tied to the input embeddings: it now has its own copy, embeddings stay frozen.")
+        head_layer = get_lm_head(model)
         for param in head_layer.parameters():
             param.requires_grad = True
         
@@ -851,7 +1240,7 @@ def main():
         for params in model.parameters():
                 params.requires_grad = False
         
-        for params in model.transformer.h[n].parameters():
+        for params in get_decoder_layers(model)[n].parameters():
                 params.requires_grad = True
 
                 
@@ -883,17 +1272,52 @@ def main():
 
 
     # Prepare everything with our `accelerator`.
-    model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
-        model, optimizer, train_dataloader, eval_dataloader
+    model, optimizer, train_dataloader, eval_dataloader, mia_train_dataloader = accelerator.prepare(
+        model, optimizer, train_dataloader, eval_dataloader, mia_train_dataloader
     )
+    if args.mia_sample_size is not None:
+        epoch_eval_dataloader, epoch_mia_train_dataloader = accelerator.prepare(
+            epoch_eval_dataloader, epoch_mia_train_dataloader
+        )
+    else:
+        epoch_eval_dataloader, epoch_mia_train_dataloader = eval_dataloader, mia_train_dataloader
+
+    # Reference losses are computed once per dataset / tokenizer / reference model and read from
+    # the cache afterwards, instead of keeping a second model around for every pass
+    ref_cache = None
+    if args.do_ref_model:
+        ref_name = args.ref_model_name_or_path or args.model_name_or_path
+        ref_cache = RefLossCache(
+            args.ref_cache_dir or os.path.join(args.output_dir, ".ref_cache"), ref_name, tokenizer,
+            {"train": mia_train_dataset, "validation": eval_dataset},
+        )
+        missing = ref_cache.missing()
+        if missing:
+            logger.info(f"Computing reference losses of {ref_name} for {missing}")
+            # Isolated RNG, so that training is the same whether the cache was hit or not
+            with torch.random.fork_rng():
+                model_ref = AutoModelForCausalLM.from_pretrained(ref_name, torch_dtype=torch.bfloat16)
+                model_ref.resize_token_embeddings(len(tokenizer))
+                model_ref.to(accelerator.device)
+                ref_dataloaders = {"train": mia_train_dataloader, "validation": eval_dataloader}
+                for split in missing:
+                    losses_ref = compute_example_losses(accelerator, model_ref, ref_dataloaders[split], args.loss_chunk_size)
+                    if accelerator.is_main_process:
+                        ref_cache.save(split, losses_ref.float().cpu().numpy())
+                del model_ref
+        accelerator.wait_for_everyone()
+        ref_cache.load()
 
-    #model_ref = accelerator.prepare(
-    #    model_ref
-    #)
+    # Frozen-layer activations are computed with the pretrained weights, before any update
+    if activation_cache is not None:
+        for split in activation_cache.missing():
+            logger.info(f"Computing the activations of the frozen layers on the {split} blocks")
+            activation_cache.compute(accelerator, model, split, block_size, mia_batch_size)
+        activation_cache.load()
 
     # On TPU, the tie weights in our model have been disconnected, so we need to restore the ties.
     # if accelerator.distributed_type == DistributedType.TPU:
-    model.tie_weights()
+    accelerator.unwrap_model(model).tie_weights()
 
     # Note -> the training dataloader needs to be prepared before we grab his length below (cause its length will be
     # shorter in multiprocess)
@@ -932,15 +1356,117 @@ def main():
     #progress_bar = tqdm(range(args.max_train_steps), disable=not accelerator.is_local_main_process)
     completed_steps = 0
     best_loss = 1000000
+    early_stopper = None
+    if args.early_stop_em_patience is not None or args.early_stop_ppl_patience is not None or args.stop_epoch_from:
+        early_stopper = EarlyStopper(
+            em_patience=args.early_stop_em_patience,
+            ppl_patience=args.early_stop_ppl_patience,
+            stop_epoch=load_stop_epoch(args.stop_epoch_from) if args.stop_epoch_from else None,
+        )
+
+    async_evaluator = None
+    if args.async_canary_eval and args.canaries_csv is not None and accelerator.is_main_process:
+        async_evaluator = AsyncEvaluator(accelerator.unwrap_model(model))
+
+    if args.canaries_csv is not None:
+        canary_kwargs = dict(
+            tokenizer=tokenizer,
+            canaries=canaries,
+            batch_size=args.canary_eval_batch_size,
+            top_k=args.canary_topk,
+            match_mode=args.canary_match_mode,
+            prefix_cache=args.canary_prefix_cache,
+            suffix_only=args.canary_suffix_only,
+            chunk_size=args.loss_chunk_size,
+        )
+        canary_log_kwargs = dict(
+            canary_ids=canaries.ids,
+            canary_suffixes=canaries.suffixes,
+            canary_splits=canaries.splits,
+            canary_log_path=canary_log_path,
+            generations_log_path=generations_log_path,
+            topk_log_path=topk_log_path if args.canary_topk > 0 else None,
+            token_store=token_store,
+            prefix_lens=canaries.prefix_lens,
+        )
+
+    # One exposure engine per high-entropy train canary, over --exposure_alphabet (inferred from the secret by default)
+    exposure_engines = []
+    if args.canary_exposure and canaries is not None:
+        for i in np.flatnonzero((canaries.types == "high_entropy") & (canaries.splits == "train")):
+            secret = canaries.suffixes[i].strip()
+            engine = ExposureEngine(
+                tokenizer, canaries.prefixes[i], secret, SecretSpace.of(secret, args.exposure_alphabet),
+                num_samples=args.exposure_samples, max_exact=args.exposure_max_exact, seed=args.seed or 0,
+                batch_size=args.canary_eval_batch_size,
+            )
+            exposure_engines.append((canaries.ids[i], canaries.splits[i], engine))
+
+    def evaluate_canaries(epoch, step):
+        """
+        Scores and logs the canaries at the current weights. Returns the results, or None when
+        they are computed in the background (--async_canary_eval).
+        """
+        if args.async_canary_eval:
+            # The main process scores a snapshot of the current weights in the background; the
+            # other processes skip canary scoring (nothing to gather, they go on training)
+            if async_evaluator is not None:
+                def canary_job(replica):
+                    return compute_canary_losses(model=replica, **canary_kwargs)
+
+                def log_canaries(results, epoch=epoch, step=step):
+                    write_canary_results(epoch, step, results, **canary_log_kwargs)
+                async_evaluator.submit(canary_job, log_canaries)
+            return None
+        canary_results = compute_canary_losses_sharded(accelerator, model=model, **canary_kwargs)
+        if accelerator.is_local_main_process:
+            write_canary_results(epoch, step, canary_results, **canary_log_kwargs)
+        if early_stopper is not None:
+            early_stopper.update_canaries(canary_results["exact_match"], canaries.splits)
+        return canary_results
+
+    # Canary evaluations inside the epochs (--eval_steps)
+    eval_scheduler = None
+    if args.eval_steps is not None and args.canaries_csv is not None:
+        eval_scheduler = AdaptiveEvalScheduler(
+            args.eval_steps, adaptive=args.adaptive_eval, budget=args.eval_budget, change_tol=args.eval_change_tol
+        )
+
+    def sync_eval_schedule():
+        # Timings differ across processes: everyone follows the main process's schedule
+        if accelerator.num_processes > 1:
+            eval_scheduler.next_step = broadcast_object_list([eval_scheduler.next_step])[0]
+
+    def timestamp():
+        # CUDA kernels run asynchronously: wait for the queued work before reading the clock
+        if accelerator.device.type == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
     for epoch in range(args.num_train_epochs):
         model.train()
         if accelerator.is_local_main_process:
             print(f"training epoch {epoch}")
+        # An optimizer step is timed from its first micro-batch, across gradient accumulation
+        step_start = None
         for step, batch in enumerate(train_dataloader):
-            outputs = model(**batch)
-            loss = outputs.loss
-            loss = loss / args.gradient_accumulation_steps
-            accelerator.backward(loss)
+            if eval_scheduler is not None and step_start is None:
+                step_start = timestamp()
+            # Backward stays in the block: checkpointed tail blocks are recomputed with the cached states
+            with activation_cache.inject(model, batch) if activation_cache is not None else nullcontext():
+                if telemetry_file is not None:
+                    # Targets that are canary tokens (past the first one) of this packed batch
+                    canary_pos = batch["canary_pos"][:, 1:]
+                    token_mask = canary_pos > 0
+                    loss, token_losses = causal_lm_loss(model, batch, args.loss_chunk_size, token_mask)
+                    write_canary_train_tokens(
+                        telemetry_file, completed_steps, epoch, canaries,
+                        batch["canary_tag"][:, 1:][token_mask], canary_pos[token_mask], token_losses,
+                    )
+                else:
+                    loss = causal_lm_loss(model, batch, args.loss_chunk_size)
+                loss = loss / args.gradient_accumulation_steps
+                accelerator.backward(loss)
             if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
                 optimizer.step()
                 lr_scheduler.step()
@@ -948,6 +1474,17 @@ def main():
        #         progress_bar.update(1)
                 completed_steps += 1
 
+                if eval_scheduler is not None:
+                    eval_scheduler.add_train_time(timestamp() - step_start)
+                    step_start = None
+                    # The last step of the epoch is covered by the end-of-epoch evaluation
+                    if eval_scheduler.should_eval(completed_steps) and step != len(train_dataloader) - 1:
+                        eval_start = timestamp()
+                        canary_results = evaluate_canaries(epoch, completed_steps)
+                        model.train()
+                        eval_scheduler.record(completed_steps, timestamp() - eval_start, canary_results)
+                        sync_eval_schedule()
+
         
                 
                 # if completed_steps % args.eval_steps == 0:
@@ -995,94 +1532,48 @@ def main():
         # --- NEW: per-epoch canary loss logging for Rethinking ---
         # --- BLOCK 4: Eval Loop Logging (Updated) ---
         if args.canaries_csv is not None:
-            global_losses, suffix_losses, exact_matches, generated_texts = compute_canary_losses(
-                model=model,
-                tokenizer=tokenizer,
-                canary_prefixes=eval_canary_prefixes,
-                canary_suffixes=eval_canary_suffixes,
-            )
-
-            if accelerator.is_local_main_process:
-                with open(canary_log_path, mode="a", encoding="utf-8") as f:
-                    for cid, g_loss, s_loss, em, split_val in zip(
-                            eval_canary_ids, global_losses, suffix_losses, exact_matches, eval_canary_splits
-                    ):
-                        f.write(f"{epoch},{cid},{g_loss},{s_loss},{em},{split_val}\n")
-
-
-                with open(generations_log_path, mode="a", encoding="utf-8") as f_gen:
-                    for cid, target, gen, em in zip(
-                            eval_canary_ids, eval_canary_suffixes, generated_texts, exact_matches
-                    ):
-                        safe_gen = gen.replace("\n", " ").replace(",", ";")
-                        safe_target = target.replace("\n", " ").replace(",", ";")
-                        status = "MEMORIZED" if em == 1 else "MISSED"
-
-                        f_gen.write(f"{epoch},{cid},{safe_target},{safe_gen},{status}\n")
-
-                print(f"\n[EPOCH {epoch} GENERATION CHECK]")
-                for cid, gen, em, split_val in zip(eval_canary_ids, generated_texts, exact_matches, eval_canary_splits):
-                    color = "\033[92m" if em == 1 else "\033[91m"
-                    reset = "\033[0m"
-                    print(f"   -> {cid} ({split_val}): '{gen}' [{color}{'MEMORIZED' if em == 1 else 'MISSED'}{reset}]")
-                print("-" * 50)
+            eval_start = timestamp()
+            canary_results = evaluate_canaries(epoch, completed_steps)
+            if eval_scheduler is not None:
+                eval_scheduler.record(completed_steps, timestamp() - eval_start, canary_results)
+                sync_eval_schedule()
         if args.add_canary:
             print("running canary eval")
-            canary_loss, fitting_loss = get_fit_canary_loss(model,fitting_canaries_ids,canary_ids)        
-            exposure = get_exposure(fitting_loss,canary_loss)
-            print(exposure)
-
-
-        
-        if args.do_ref_model:
-            model_ref.eval()
-            losses_ref = []
-            
-        for step, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
-                outputs = model(**batch)
-                
+            exposure = exposure_engine.exposure(model, accelerator)
+            if accelerator.is_local_main_process:
+                print(exposure)
+        if exposure_engines:
+            write_canary_exposure(epoch, completed_steps, exposure_engines, model, accelerator, exposure_log_path)
 
-            loss = outputs.loss
-            losses.append(accelerator.gather(loss.repeat(args.per_device_eval_batch_size)))
-            
-            if args.do_ref_model:
-                with torch.no_grad():
-                    outputs_ref =model_ref(**batch)
-                loss_ref = outputs_ref.loss
-                losses_ref.append(accelerator.gather(loss_ref.repeat(args.per_device_eval_batch_size)))
-                
-            
 
-        losses = torch.cat(losses)
-        losses = losses[: len(eval_dataset)]
-     
         
+        # Per-example losses of the validation set, in dataset order
+        losses = compute_example_losses(accelerator, model, epoch_eval_dataloader, args.loss_chunk_size, activation_cache)
         if args.do_ref_model:
-            losses_ref = torch.cat(losses_ref)
-            losses_ref = losses_ref[: len(eval_dataset)]
-            sorted_ratio = sorted([l-l_ref for l,l_ref in zip (losses,losses_ref)])
-        
-        sorted_loss = sorted(losses)
+            losses_ref = ref_cache.get("validation", eval_sample, losses.device)
+            val_ratio = losses - losses_ref
+        val_losses = losses
         
+        # Lower loss means member: a training example is flagged when its loss is below the threshold
         if args.do_ref_model:
-            threshold_ref = sorted_ratio[int(0.1*len(sorted_ratio))]
-            threshold = sorted_loss[int(0.1*len(losses))]
+            threshold_ref = -threshold_at_fpr(-val_ratio.cpu().numpy(), 0.1)
+            threshold = -threshold_at_fpr(-losses.cpu().numpy(), 0.1)
             if accelerator.is_local_main_process:
-                print("threshold_ref is: " , threshold_ref.detach().item())
-                print("threshold is: " , threshold.detach().item())
+                print("threshold_ref is: " , threshold_ref)
+                print("threshold is: " , threshold)
         else:
-            threshold = sorted_loss[int(0.1*len(losses))]
+            threshold = -threshold_at_fpr(-losses.cpu().numpy(), 0.1)
             if accelerator.is_local_main_process:
-                print("threshold is: " , threshold.detach().item())
+                print("threshold is: " , threshold)
         try:
             perplexity = math.exp(torch.mean(losses))
         except OverflowError:
             perplexity = float("inf")
+        perplexity_low, perplexity_high = perplexity_interval(losses)
+        num_val = len(losses)
 
-        if accelerator.is_local_main_process:
-            with open(metrics_summary_path, mode="a", encoding="utf-8") as f_sum:
-                f_sum.write(f"{epoch},{perplexity}\n")
+        if early_stopper is not None:
+            early_stopper.update_perplexity(perplexity)
 
         
         # if torch.mean(losses) < best_loss:
@@ -1109,67 +1600,67 @@ def main():
           
         ################################################    
         #run threshold on training samples
-        losses = []
+        losses = compute_example_losses(accelerator, model, epoch_mia_train_dataloader, args.loss_chunk_size, activation_cache)
         if args.do_ref_model:
-            model_ref.eval()
-            losses_ref = []
-            
-        for step, batch in enumerate(train_dataloader):
-            with torch.no_grad():
-                outputs = model(**batch)
+            losses_ref = ref_cache.get("train", train_sample, losses.device)
+            lr_rat = losses - losses_ref
 
-            loss = outputs.loss
-            
-            losses.append(accelerator.gather(loss.repeat(args.per_device_train_batch_size)))
-            if args.do_ref_model:
-                with torch.no_grad():
-                    outputs_ref =model_ref(**batch)
-                loss_ref = outputs_ref.loss
-                losses_ref.append(accelerator.gather(loss_ref.repeat(args.per_device_train_batch_size)))
-              
-              
-        
-
-        accelerator.wait_for_everyone()
-        losses = torch.cat(losses)
-        losses = losses[: len(train_dataset)]
-
-        
         if args.do_ref_model:
-            losses_ref = torch.cat(losses_ref)
-            losses_ref = losses_ref[: len(train_dataset)]
-            lr_rat = [l-l_r for l,l_r in zip(losses,losses_ref)]
-            
-        if args.do_ref_model:
-            guess_cor = sum([1 for sample in losses if sample<threshold])
-            guess_cor_ref =  sum([1 for sample in lr_rat if sample<threshold_ref])
-        else:    
-            guess_cor = sum([1 for sample in losses if sample<threshold])
-
+            guess_cor = (losses < threshold).sum().item()
+            guess_cor_ref = (lr_rat < threshold_ref).sum().item()
+        else:
+            guess_cor = (losses < threshold).sum().item()
 
-        
         try:
             perplexity_train = math.exp(torch.mean(losses))
         except OverflowError:
             perplexity_train = float("inf")
+        mia_low, mia_high = wilson_interval(guess_cor, len(losses))
+        attacks = {"loss": (losses, val_losses)}
+        if args.do_ref_model:
+            attacks["ref"] = (lr_rat, val_ratio)
+        mia_roc = loss_attack_roc(attacks, mia_fprs)
         #assert(len(losses)==len(lr_rat))
         if accelerator.is_local_main_process:
+            with open(metrics_summary_path, mode="a", encoding="utf-8") as f_sum:
+                f_sum.write(
+                    f"{epoch},{completed_steps},{perplexity},{perplexity_low},{perplexity_high},"
+                    f"{guess_cor/len(losses)},{mia_low},{mia_high},{num_val},{len(losses)},"
+                    + ",".join(str(v) for v in [mia_roc["loss"]["auc"], *mia_roc["loss"]["tpr"]]) + "\n"
+                )
             if args.do_ref_model:
                 print("correct cnt  ref is: " , guess_cor_ref, "all is: ", len(losses), "ratio is: ", guess_cor_ref/len(losses))
             print("correct cnt is: " , guess_cor, "all is: ", len(losses), "ratio is: ", guess_cor/len(losses))
             print(f"epoch {epoch}: perplexity: {perplexity} perplexity_train: {perplexity_train}")
+            print(f"95% CI ({num_val} val / {len(losses)} train examples): perplexity [{perplexity_low}, {perplexity_high}] "
+                  f"ratio [{mia_low}, {mia_high}]")
+            print_attack_roc(mia_roc, mia_fprs)
             print("____")
             if args.do_ref_model:
                 print(f"{guess_cor_ref/len(losses)}\n{guess_cor/len(losses)}\n{perplexity}\n{perplexity_train}")
-                ratio = len(train_dataset)/len(eval_dataset)
-                guess_cor_subsampled = sum([1 for sample in losses[::int(ratio)] if sample<threshold])
-                guess_cor_ref_subsampled =  sum([1 for sample in lr_rat[::int(ratio)] if sample<threshold_ref])                
-                print(f"{guess_cor_ref_subsampled/(len(lr_rat[::int(ratio)]))}\n{guess_cor_subsampled/len(losses[::int(ratio)])}\n{guess_cor_ref_subsampled/(guess_cor_ref_subsampled+int(0.1*len(eval_dataset)))}\n{guess_cor_subsampled/(guess_cor_subsampled+int(0.1*len(eval_dataset)))}")
+                ratio = max(1, int(len(losses)/num_val))
+                guess_cor_subsampled = (losses[::ratio] < threshold).sum().item()
+                guess_cor_ref_subsampled = (lr_rat[::ratio] < threshold_ref).sum().item()
+                print(f"{guess_cor_ref_subsampled/(len(lr_rat[::ratio]))}\n{guess_cor_subsampled/len(losses[::ratio])}\n{guess_cor_ref_subsampled/(guess_cor_ref_subsampled+int(0.1*num_val))}\n{guess_cor_subsampled/(guess_cor_subsampled+int(0.1*num_val))}")
 
             else:
                 print(f"{guess_cor/len(losses)}\n{perplexity}\n{perplexity_train}")
             print("_____")
 
+        if early_stopper is not None and early_stopper.should_stop(epoch):
+            if accelerator.is_local_main_process:
+                print(f"Early stopping after epoch {epoch}: {early_stopper.reason}")
+            break
+
+    if early_stopper is not None and accelerator.is_main_process:
+        early_stopper.save(early_stop_path, epoch, completed_steps)
+
+    if async_evaluator is not None:
+        async_evaluator.close()
+    if telemetry_file is not None:
+        telemetry_file.close()
+    accelerator.wait_for_everyone()
+
     model.eval()
     losses = []
     if accelerator.is_local_main_process:
@@ -1177,50 +1668,28 @@ def main():
     
     if args.add_canary:
             print("running canary eval")
-            canary_loss, fitting_loss = get_fit_canary_loss(model,fitting_canaries_ids,canary_ids)        
-            exposure = get_exposure(fitting_loss,canary_loss)
-            print(exposure)    
-    
-    if args.do_ref_model:
-        model_ref.eval()
-        losses_ref = []
-        
-    for step, batch in enumerate(eval_dataloader):
-        with torch.no_grad():
-            outputs = model(**batch)
-            
-
-        loss = outputs.loss
-        losses.append(accelerator.gather(loss.repeat(args.per_device_eval_batch_size)))
-        
-        if args.do_ref_model:
-            with torch.no_grad():
-                outputs_ref =model_ref(**batch)
-            loss_ref = outputs_ref.loss
-            losses_ref.append(accelerator.gather(loss_ref.repeat(args.per_device_eval_batch_size)))
-            
-        
-
-    losses = torch.cat(losses)
-    losses = losses[: len(eval_dataset)]
+            exposure = exposure_engine.exposure(model, accelerator)
+            if accelerator.is_local_main_process:
+                print(exposure)
     
+    # Per-example losses of the validation set, in dataset order
+    losses = compute_example_losses(accelerator, model, eval_dataloader, args.loss_chunk_size, activation_cache)
     if args.do_ref_model:
-        losses_ref = torch.cat(losses_ref)
-        losses_ref = losses_ref[: len(eval_dataset)]
-        sorted_ratio = sorted([l-l_ref for l,l_ref in zip (losses,losses_ref)])
-    
-    sorted_loss = sorted(losses)
+        losses_ref = ref_cache.get("validation", device=losses.device)
+        val_ratio = losses - losses_ref
+    val_losses = losses
     
+    # Lower loss means member: a training example is flagged when its loss is below the threshold
     if args.do_ref_model:
-        threshold_ref = sorted_ratio[int(0.1*len(sorted_ratio))]
-        threshold = sorted_loss[int(0.1*len(losses))]
+        threshold_ref = -threshold_at_fpr(-val_ratio.cpu().numpy(), 0.1)
+        threshold = -threshold_at_fpr(-losses.cpu().numpy(), 0.1)
         if accelerator.is_local_main_process:
-            print("threshold_ref is: " , threshold_ref.detach().item())
-            print("threshold is: " , threshold.detach().item())
+            print("threshold_ref is: " , threshold_ref)
+            print("threshold is: " , threshold)
     else:
-        threshold = sorted_loss[int(0.1*len(losses))]
+        threshold = -threshold_at_fpr(-losses.cpu().numpy(), 0.1)
         if accelerator.is_local_main_process:
-            print("threshold is: " , threshold.detach().item())
+            print("threshold is: " , threshold)
     try:
         perplexity = math.exp(torch.mean(losses))
     except OverflowError:
@@ -1230,46 +1699,17 @@ def main():
     
         
     #run threshold on training samples
-    losses = []
+    losses = compute_example_losses(accelerator, model, mia_train_dataloader, args.loss_chunk_size, activation_cache)
     if args.do_ref_model:
-        model_ref.eval()
-        losses_ref = []
-        
-    for step, batch in enumerate(train_dataloader):
-        with torch.no_grad():
-            outputs = model(**batch)
-
-        loss = outputs.loss
-        losses.append(accelerator.gather(loss.repeat(args.per_device_train_batch_size)))
-        
-        if args.do_ref_model:
-            with torch.no_grad():
-                outputs_ref =model_ref(**batch)
-            loss_ref = outputs_ref.loss
-            losses_ref.append(accelerator.gather(loss_ref.repeat(args.per_device_train_batch_size)))
-                        
-
-    accelerator.wait_for_everyone()
-    
-    losses = torch.cat(losses)
+        losses_ref = ref_cache.get("train", device=losses.device)
+        lr_rat = losses - losses_ref
 
-    
-    losses = losses[: len(train_dataset)]
-    
-    
-    if args.do_ref_model:
-        losses_ref = torch.cat(losses_ref)
-        losses_ref = losses_ref[: len(train_dataset)]
-        lr_rat = [l-l_r for l,l_r in zip(losses,losses_ref)]
-        
     if args.do_ref_model:
-        guess_cor = sum([1 for sample in losses if sample<threshold])
-        guess_cor_ref =  sum([1 for sample in lr_rat if sample<threshold_ref])
-    else:    
-        guess_cor = sum([1 for sample in losses if sample<threshold])
-
+        guess_cor = (losses < threshold).sum().item()
+        guess_cor_ref = (lr_rat < threshold_ref).sum().item()
+    else:
+        guess_cor = (losses < threshold).sum().item()
 
-    
     try:
         perplexity_train = math.exp(torch.mean(losses))
     except OverflowError:
@@ -1280,13 +1720,21 @@ def main():
             print("correct cnt  ref is: " , guess_cor_ref, "all is: ", len(losses), "ratio is: ", guess_cor_ref/len(losses))
         print("correct cnt is: " , guess_cor, "all is: ", len(losses), "ratio is: ", guess_cor/len(losses))
         print(f"end of training perplexity: {perplexity} perplexity_train: {perplexity_train}")
+        perplexity_low, perplexity_high = perplexity_interval(losses)
+        mia_low, mia_high = wilson_interval(guess_cor, len(losses))
+        print(f"95% CI (train examples, full pass): perplexity_train [{perplexity_low}, {perplexity_high}] "
+              f"ratio [{mia_low}, {mia_high}]")
+        attacks = {"loss": (losses, val_losses)}
+        if args.do_ref_model:
+            attacks["ref"] = (lr_rat, val_ratio)
+        print_attack_roc(loss_attack_roc(attacks, mia_fprs), mia_fprs)
         print("____")
         if args.do_ref_model:
                 print(f"{guess_cor_ref/len(losses)}\n{guess_cor/len(losses)}\n{perplexity}\n{perplexity_train}")
-                ratio = len(train_dataset)/len(eval_dataset)
-                guess_cor_subsampled = sum([1 for sample in losses[::int(ratio)] if sample<threshold])
-                guess_cor_ref_subsampled =  sum([1 for sample in lr_rat[::int(ratio)] if sample<threshold_ref])                
-                print(f"{guess_cor_ref_subsampled/(len(lr_rat[::int(ratio)]))}\n{guess_cor_subsampled/len(losses[::int(ratio)])}\n{guess_cor_ref_subsampled/(guess_cor_ref_subsampled+int(0.1*len(eval_dataset)))}\n{guess_cor_subsampled/(guess_cor_subsampled+int(0.1*len(eval_dataset)))}")
+                ratio = max(1, int(len(mia_train_dataset)/len(eval_dataset)))
+                guess_cor_subsampled = (losses[::ratio] < threshold).sum().item()
+                guess_cor_ref_subsampled = (lr_rat[::ratio] < threshold_ref).sum().item()
+                print(f"{guess_cor_ref_subsampled/(len(lr_rat[::ratio]))}\n{guess_cor_subsampled/len(losses[::ratio])}\n{guess_cor_ref_subsampled/(guess_cor_ref_subsampled+int(0.1*len(eval_dataset)))}\n{guess_cor_subsampled/(guess_cor_subsampled+int(0.1*len(eval_dataset)))}")
 
         else:
             print(f"{guess_cor/len(losses)}\n{perplexity}\n{perplexity_train}")
@@ -159,7 +159,9 @@ echo "Log M_C found:   $LOG_C"
 python "$SCRIPT_EVAL" \
     --loss_noC_csv "$LOG_NOC" \
     --loss_C_csv "$LOG_C" \
-    --output_dir "$DIR_RESULTS"
+    --output_dir "$DIR_RESULTS" \
+    --canaries_csv "$CANARY_FILE" \
+    --tokenizer_name "$MODEL_NAME"
 
 # Capture Total End Time
 TOTAL_END=$(date +%s)
@@ -0,0 +1,139 @@
+import csv
+import hashlib
+from itertools import count, islice
+
+import numpy as np
+import torch
+
+from corpus_cache import PackedBlocks
+
+
+class StreamingBlocks(torch.utils.data.IterableDataset):
+    """
+    Training blocks tokenized and packed on the fly from a streamed text corpus, for corpora
+    that do not fit in memory.
+
+    Texts are tokenized 1,000 at a time and cut into block_size blocks (the remainder of every
+    group is dropped, or carried over with carry_remainder; short groups are dropped, blocks
+    being fixed-width), then go through a shuffle buffer of shuffle_buffer blocks. The source
+    is read again from the start whenever it is exhausted. An epoch is blocks_per_epoch base
+    blocks plus the canary blocks: rows of a canary_table, either exactly the rows of index
+    (one entry per repetition) or, with canary_rate, as many as needed for that fraction of
+    the epoch, cycling through index. Canaries are placed at seeded random positions, which
+    are appended to position_log (epoch, position, canary_id). Memory use only depends on the
+    buffer and the canaries.
+    """
+
+    def __init__(self, source, text_column, tokenizer, block_size, blocks_per_epoch, table=None, index=None,
+                 names=None, canary_rate=None, shuffle_buffer=1000, seed=0, tag_base=False,
+                 carry_remainder=False, position_log=None):
+        self.source = source
+        self.text_column = text_column
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.blocks_per_epoch = blocks_per_epoch
+        self.table = table
+        self.names = names
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.tag_base = tag_base
+        self.carry_remainder = carry_remainder
+        self.position_log = position_log
+
+        index = np.zeros(0, dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+        if canary_rate is not None and table is not None:
+            if len(index) == 0:
+                index = np.arange(len(table["input_ids"]))
+            num_canaries = int(round(canary_rate * blocks_per_epoch / (1 - canary_rate)))
+            index = np.resize(index, num_canaries)
+        self.canary_rows = index
+        self.epoch = 0
+        self._blocks = None
+
+    def __len__(self):
+        return self.blocks_per_epoch + len(self.canary_rows)
+
+    def _packed(self):
+        """
+        Endless stream of [n, block_size] int32 arrays, one per group of 1,000 texts.
+        """
+        leftover = np.zeros(0, dtype=np.int32)
+        for _ in count():
+            produced = False
+            texts = (str(example[self.text_column]) for example in self.source)
+            while True:
+                group = list(islice(texts, 1000))
+                if not group:
+                    break
+                ids = self.tokenizer(group)["input_ids"]
+                tokens = np.fromiter((t for doc in ids for t in doc), dtype=np.int32)
+                if self.carry_remainder:
+                    tokens = np.concatenate([leftover, tokens])
+                n = len(tokens) // self.block_size
+                leftover = tokens[n * self.block_size:]
+                if n > 0:
+                    produced = True
+                    yield tokens[:n * self.block_size].reshape(n, self.block_size)
+            if not produced:
+                raise ValueError(f"The streamed corpus does not hold a single block of {self.block_size} tokens.")
+
+    def _shuffled(self):
+        rng = np.random.default_rng(self.seed)
+        buffer = np.empty((self.shuffle_buffer, self.block_size), dtype=np.int32)
+        filled = 0
+        for blocks in self._packed():
+            for block in blocks:
+                if filled < self.shuffle_buffer:
+                    buffer[filled] = block
+                    filled += 1
+                    continue
+                j = rng.integers(self.shuffle_buffer)
+                out = buffer[j].copy()
+                buffer[j] = block
+                yield out
+
+    def _base_item(self, block):
+        ids = block.astype(np.int64, copy=False)
+        item = {"input_ids": ids, "attention_mask": np.ones_like(ids), "labels": ids}
+        if self.tag_base:
+            untagged = np.full_like(ids, -1)
+            item.update(canary_tag=untagged, canary_pos=untagged)
+        return item
+
+    def __iter__(self):
+        # The block stream goes on across epochs: epoch e trains on the next blocks_per_epoch blocks
+        if self._blocks is None:
+            self._blocks = self._shuffled()
+        epoch = self.epoch
+        self.epoch += 1
+
+        rng = np.random.default_rng([self.seed, epoch])
+        total = len(self)
+        positions = np.sort(rng.choice(total, size=len(self.canary_rows), replace=False))
+        rows = rng.permutation(self.canary_rows)
+        if self.position_log is not None and len(rows):
+            with open(self.position_log, mode="a", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(
+                    (epoch, int(p), self.names[r] if self.names is not None else int(r)) for p, r in zip(positions, rows)
+                )
+
+        next_canary = 0
+        for position in range(total):
+            if next_canary < len(positions) and positions[next_canary] == position:
+                row = rows[next_canary]
+                next_canary += 1
+                yield {key: values[row] for key, values in self.table.items()}
+            else:
+                yield self._base_item(next(self._blocks))
+
+    def members(self, num_blocks):
+        """
+        The first num_blocks base blocks of the stream, i.e. blocks trained on in the first
+        epoch (num_blocks <= blocks_per_epoch), as an in-memory PackedBlocks.
+        """
+        num_blocks = min(num_blocks, self.blocks_per_epoch)
+        blocks = np.stack(list(islice(self._shuffled(), num_blocks)))
+        tokens = blocks.reshape(-1)
+        fingerprint = hashlib.sha1(tokens.tobytes()).hexdigest()[:16]
+        offsets = np.arange(num_blocks + 1, dtype=np.int64) * self.block_size
+        return PackedBlocks(tokens, offsets, fingerprint)